@@ -0,0 +1,376 @@
+"""
+benchmarks.py
+
+Micro-benchmarks for the hot paths of a check. Run with:
+
+    python benchmarks.py [name ...]
+"""
+import os
+import random
+import smtplib
+import string
+import sys
+import tempfile
+import time
+import timeit
+from email.mime.text import MIMEText
+
+from differ import DIFF_ALGORITHMS, diff_blocks, diff_markup
+from email_notifier import SMTPConnectionPool
+from email_renderer import STYLE_PATH, TEMPLATE_PATH, EmailRenderer
+from extractor import (
+    BACKENDS,
+    EXTRACTION_MODES,
+    available_backends,
+    extract_element,
+    extract_raw_element,
+    probe_backends,
+    sample_page,
+)
+from fingerprint import ALGORITHMS, fingerprint
+from keyword_matcher import KeywordMatcher, ahocorasick
+from merkle import build_tree, changed_blocks, deserialize, serialize
+from normalizer import COMMON_SCRUBBERS, Normalizer
+from scheduler import WatchScheduler
+from state_store import StateStore
+from tests.smtp_stand_in import LocalSMTPServer
+from watch import Watch
+
+
+def _report(label, seconds, baseline=None):
+    """Print one timing line, with the speedup against the baseline."""
+    line = f"  {label:<24} {seconds * 1000:10.2f} ms"
+    if baseline:
+        line += f"  x{baseline / seconds:.1f}"
+    print(line)
+
+
+def _best_of(func, repeat=5, number=1):
+    """Return the best time per call of func."""
+    return min(timeit.repeat(func, repeat=repeat, number=number)) / number
+
+
+def bench_extraction():
+    """Compare the extraction modes on 1-3 MB pages."""
+    for size in (1_000_000, 2_000_000, 3_000_000):
+        html = sample_page(size)
+        print(f"extraction, {len(html) / 1e6:.1f} MB page")
+        baseline = None
+        for mode in EXTRACTION_MODES:
+            seconds = _best_of(
+                lambda html=html, mode=mode: extract_element(
+                    html, "welcome", mode=mode, backend="html.parser"),
+                repeat=3)
+            baseline = baseline or seconds
+            _report(mode, seconds, baseline)
+
+
+def bench_raw_section():
+    """Compare decode + extract + fingerprint with the raw byte range path."""
+    for size in (1_000_000, 3_000_000):
+        body = sample_page(size).encode()
+        print(f"section fingerprint, {len(body) / 1e6:.1f} MB body")
+        baseline = None
+        for mode in ("full", "stream"):
+            seconds = _best_of(
+                lambda body=body, mode=mode: fingerprint(extract_element(
+                    body.decode(), "welcome", mode=mode,
+                    backend="html.parser")),
+                repeat=3)
+            baseline = baseline or seconds
+            _report(mode, seconds, baseline)
+
+        def fingerprint_raw(body=body):
+            section = extract_raw_element(body, "welcome")
+            assert section is not None
+            return fingerprint(section.view)
+
+        _report("raw", _best_of(fingerprint_raw, repeat=3), baseline)
+
+
+def bench_backends():
+    """Compare the available parser backends in each mode they support."""
+    html = sample_page(1_000_000)
+    print(f"parser backends, {len(html) / 1e6:.1f} MB page")
+    baseline = None
+    for name in available_backends():
+        for mode in BACKENDS[name].modes:
+            seconds = _best_of(
+                lambda name=name, mode=mode: extract_element(
+                    html, "welcome", mode=mode, backend=name),
+                repeat=3)
+            baseline = baseline or seconds
+            _report(f"{name} {mode}", seconds, baseline)
+    print("  startup probe ranking: " +
+          ", ".join(name for name, _ in probe_backends()))
+
+
+def bench_keywords():
+    """Compare per-keyword scans with the automaton at 10/100/1000 keywords."""
+    rng = random.Random(0)
+    content = extract_element(sample_page(200_000), "welcome",
+                              backend="html.parser")
+    assert content is not None
+    content = content * (50_000 // len(content) + 1)
+    print(f"keywords, {len(content) / 1e3:.0f} KB section")
+    for count in (10, 100, 1000):
+        keywords = [
+            "".join(rng.choices(string.ascii_lowercase, k=rng.randint(4, 10)))
+            for _ in range(count)
+        ]
+        matcher = KeywordMatcher(keywords)
+        print(f"  {count} keywords")
+        baseline = _best_of(
+            lambda keywords=keywords: any(
+                keyword in content.lower() for keyword in keywords))
+        _report("per-keyword lower()", baseline)
+        implementation = "C" if ahocorasick else "Python"
+        _report(f"automaton ({implementation})", _best_of(
+            lambda matcher=matcher: matcher.find_all(content)), baseline)
+
+
+def _send_unpooled(port, message):
+    """Deliver one message the way the notifier did before pooling."""
+    with smtplib.SMTP("127.0.0.1", port) as server:
+        server.ehlo()
+        server.login("user", "password")
+        server.sendmail("monitor@localhost", ["team@localhost"], message)
+
+
+def bench_smtp(count=200):
+    """Compare messages/sec with a connection per message and with the pool."""
+    message = MIMEText("<p>Content Updated</p>", "html").as_string()
+    for latency in (0.0, 0.002):
+        print(f"smtp, {count} messages, {latency * 1000:.0f} ms reply latency")
+        with LocalSMTPServer(latency) as server:
+            started = time.perf_counter()
+            for _ in range(count):
+                _send_unpooled(server.port, message)
+            unpooled = count / (time.perf_counter() - started)
+            print(f"  {'connection per message':<24} {unpooled:10.0f} msg/s")
+
+            pool = SMTPConnectionPool("127.0.0.1", server.port, "user",
+                                      "password", starttls=False)
+            started = time.perf_counter()
+            for _ in range(count):
+                pool.send("monitor@localhost", ["team@localhost"], message)
+            pooled = count / (time.perf_counter() - started)
+            pool.close()
+            print(f"  {'pooled':<24} {pooled:10.0f} msg/s  "
+                  f"x{pooled / unpooled:.1f}")
+
+
+def bench_recipients(count=20, team=20):
+    """Compare one message per recipient with one message to every RCPT."""
+    message = MIMEText("<p>Content Updated</p>", "html").as_string()
+    recipients = [f"member{i}@localhost" for i in range(team)]
+    print(f"smtp, {count} notifications to {team} recipients, "
+          f"2 ms reply latency")
+    with LocalSMTPServer(0.002) as server:
+        pool = SMTPConnectionPool("127.0.0.1", server.port, "user",
+                                  "password", starttls=False)
+        started = time.perf_counter()
+        for _ in range(count):
+            for recipient in recipients:
+                pool.send("monitor@localhost", [recipient], message)
+        baseline = time.perf_counter() - started
+        _report("message per recipient", baseline)
+        del server.deliveries[:]
+        started = time.perf_counter()
+        for _ in range(count):
+            pool.send("monitor@localhost", recipients, message)
+        _report("one message, many RCPT", time.perf_counter() - started,
+                baseline)
+        pool.close()
+        assert server.deliveries == [recipients] * count
+
+
+def bench_state_store(count=10_000):
+    """Compare per-watch commits with batched watch state writes."""
+    watches = [Watch(f"https://example.com/{index}") for index in range(count)]
+    for watch in watches:
+        watch.fingerprint = bytes(16)
+        watch.fingerprint_algorithm = "blake2b"
+        watch.content = "<section>" + "x" * 2000 + "</section>"
+        watch.last_checked_at = time.time()
+    print(f"state store, {count} watches")
+    with tempfile.TemporaryDirectory() as directory:
+        store = StateStore(os.path.join(directory, "unbatched.db"))
+        started = time.perf_counter()
+        for watch in watches:
+            store.save_watch_state(watch)
+        unbatched = count / (time.perf_counter() - started)
+        store.close()
+        print(f"  {'commit per watch':<24} {unbatched:10.0f} watches/s")
+
+        store = StateStore(os.path.join(directory, "batched.db"))
+        started = time.perf_counter()
+        for watch in watches:
+            store.queue_watch_state(watch)
+        store.flush()
+        batched = count / (time.perf_counter() - started)
+        store.close()
+        print(f"  {'batched':<24} {batched:10.0f} watches/s  "
+              f"x{batched / unbatched:.1f}")
+
+
+def bench_fingerprint():
+    """Compare the fingerprint algorithms on 1 KB to 10 MB sections."""
+    for size in (1 << 10, 64 << 10, 1 << 20, 10 << 20):
+        section = "<section>" + "x" * (size - 20) + "</section>"
+        number = max(1, (1 << 24) // size)
+        print(f"fingerprint, {size >> 10} KB section")
+        baseline = _best_of(lambda section=section: fingerprint(section, "md5"),
+                            number=number)
+        for algorithm in ALGORITHMS:
+            seconds = _best_of(
+                lambda section=section, algorithm=algorithm: fingerprint(
+                    section, algorithm),
+                number=number)
+            _report(f"{algorithm} ({size / seconds / 1e9:.2f} GB/s)",
+                    seconds, baseline)
+
+
+def bench_merkle(rows=10_000):
+    """Time building, storing and diffing the Merkle tree of a big section."""
+    row = "<tr><td>Event {0}</td><td class=\"price\">{0}.00 PLN</td></tr>"
+    old = ('<section id="welcome"><table>' +
+           "".join(row.format(index) for index in range(rows)) +
+           "</table></section>")
+    new = old.replace(row.format(rows // 2), row.format("changed"))
+    print(f"merkle tree, {rows} rows, {len(old) / 1e6:.1f} MB section")
+    _report("build", _best_of(lambda: build_tree(new), repeat=3))
+    stored = serialize(build_tree(old))
+    tree = build_tree(new)
+    _report(f"deserialize ({len(stored) // 1024} KB)",
+            _best_of(lambda: deserialize(stored), repeat=3))
+    old_tree = deserialize(stored)
+    _report("changed blocks",
+            _best_of(lambda: changed_blocks(old_tree, tree), repeat=3))
+
+
+def bench_diff(rows=3000):
+    """Time the diff modes on a big section with a few edited rows."""
+    row = "<tr><td>Event {0}</td><td>{0}.00 PLN</td></tr>"
+    old = ('<section id="welcome"><table>' +
+           "".join(row.format(index) for index in range(rows)) +
+           "</table></section>")
+    new = (old.replace(row.format(10), "")
+              .replace("Event 1500<", "Event 1500 SOLD OUT<")
+              .replace("2000.00", "2100.00"))
+    print(f"diff, {rows} rows, {len(old) / 1e3:.0f} KB section")
+    for granularity in ("line", "word"):
+        for algorithm in DIFF_ALGORITHMS:
+            _report(f"{granularity} {algorithm}", _best_of(
+                lambda granularity=granularity, algorithm=algorithm:
+                    diff_markup(old, new, granularity, algorithm),
+                repeat=3))
+    _report("dom", _best_of(lambda: diff_blocks(old, new), repeat=3))
+
+
+def bench_normalize(rows=10_000):
+    """Time each normalization rule alone and the whole pipeline."""
+    row = ("<tr data-token=\"{0:x}\"><td>Event {0}</td>"
+           "<td class=\"price\">{0}.00 PLN</td>"
+           "<td class=\"ad\"><img src=\"/b.png?v={0}\"></td></tr>\n")
+    markup = ('<section id="welcome"><script>var now = 1;</script><table>' +
+              "".join(row.format(index) for index in range(rows)) +
+              "</table></section>")
+    print(f"normalize, {rows} rows, {len(markup) / 1e6:.1f} MB section")
+    rules = {
+        "strip scripts": {"strip_scripts": True},
+        "ignore selector": {"ignore_selectors": ["td.ad"]},
+        "drop attribute": {"drop_attributes": ["data-token"]},
+        "scrubbers": {"scrubbers": COMMON_SCRUBBERS},
+        "collapse whitespace": {"collapse_whitespace": True},
+    }
+    for label, options in rules.items():
+        normalizer = Normalizer(**options)
+        _report(label, _best_of(lambda normalizer=normalizer: normalizer(markup),
+                                repeat=3))
+    normalizer = Normalizer(**{key: value for options in rules.values()
+                               for key, value in options.items()})
+    _report("pipeline", _best_of(lambda: normalizer(markup), repeat=3))
+
+
+def bench_render(count=1000):
+    """Compare compiling the email template per email with the cached one."""
+    body = "<ul>" + "<li><code>tr:nth-of-type(3)</code> changed</li>" * 20
+    body += "</ul>"
+
+    def compile_each_time():
+        from jinja2 import Template
+        with open(STYLE_PATH, encoding="utf-8") as style_file:
+            style = style_file.read()
+        with open(TEMPLATE_PATH, encoding="utf-8") as template_file:
+            template = Template(template_file.read())
+        return template.render(style=style, subject="Content Updated",
+                               content=body)
+
+    print(f"email rendering, {count} emails")
+    baseline = _best_of(
+        lambda: [compile_each_time() for _ in range(count)], repeat=3)
+    _report("compile per email", baseline)
+    renderer = EmailRenderer()
+    _report("cached template", _best_of(
+        lambda: [renderer.render("Content Updated", body)
+                 for _ in range(count)], repeat=3), baseline)
+    with tempfile.TemporaryDirectory() as cache_dir:
+        EmailRenderer(cache_dir=cache_dir)
+        _report("startup, compiled", _best_of(EmailRenderer, repeat=3))
+        _report("startup, bytecode cache", _best_of(
+            lambda: EmailRenderer(cache_dir=cache_dir), repeat=3))
+
+
+def bench_scheduler(count=100_000):
+    """Time scheduling and dispatching 100k watches with mixed intervals."""
+    rng = random.Random(0)
+    watches = [
+        Watch(f"https://example.com/{index}",
+              interval=rng.choice((60, 300, 1800, 3600)))
+        for index in range(count)
+    ]
+    scheduler = WatchScheduler(300)
+    print(f"scheduler, {count} watches")
+    started = time.perf_counter()
+    for watch in watches:
+        scheduler.schedule(watch, rng.uniform(0, 3600))
+    elapsed = time.perf_counter() - started
+    print(f"  {'schedule':<24} {elapsed / count * 1e6:10.2f} us/watch")
+
+    started = time.perf_counter()
+    dispatched = 0
+    for now in range(0, 3600, 10):
+        for watch, _ in scheduler.pop_due(now):
+            scheduler.schedule(watch, now + scheduler.interval_of(watch))
+            dispatched += 1
+    elapsed = time.perf_counter() - started
+    print(f"  {'pop due + reschedule':<24} {elapsed / dispatched * 1e6:10.2f} "
+          f"us/check ({dispatched} checks)")
+
+
+BENCHMARKS = {
+    "extraction": bench_extraction,
+    "backends": bench_backends,
+    "keywords": bench_keywords,
+    "smtp": bench_smtp,
+    "recipients": bench_recipients,
+    "state": bench_state_store,
+    "scheduler": bench_scheduler,
+    "fingerprint": bench_fingerprint,
+    "raw": bench_raw_section,
+    "merkle": bench_merkle,
+    "diff": bench_diff,
+    "normalize": bench_normalize,
+    "render": bench_render,
+}
+
+
+def main(names):
+    """Run the named benchmarks, or all of them."""
+    for name in names or BENCHMARKS:
+        BENCHMARKS[name]()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,208 @@
+"""
+channels.py
+"""
+import asyncio
+import json
+import socket
+import threading
+import time
+
+from email_notifier import send_notification_email
+from scheduler import TimingStats
+
+FILE_FORMATS = ("jsonl", "syslog")
+
+# Facility user (1) and severity notice (5), as <PRI> = facility * 8 + severity.
+_SYSLOG_PRIORITY = 1 * 8 + 5
+
+
+class DeliveryRefused(Exception):
+    """
+    Raised by a channel when it delivered a notification only in part, so
+    a retry would repeat it for those who already have it.
+    """
+
+
+class ChannelMetrics:
+    """
+    Delivery counters and latency of one channel.
+    """
+
+    def __init__(self):
+        self.sent = 0
+        self.failed = 0
+        self.timeouts = 0
+        self.latency = TimingStats()
+
+    def __str__(self):
+        return (
+            f"sent={self.sent} failed={self.failed} timeouts={self.timeouts} "
+            f"p50={self.latency.percentile(0.5) * 1000:.1f}ms "
+            f"p99={self.latency.percentile(0.99) * 1000:.1f}ms "
+            f"max={self.latency.max * 1000:.1f}ms"
+        )
+
+
+class Channel:
+    """
+    A destination for notifications. Subclasses implement send(), which
+    raises on failure so the outbox retries the notification on this
+    channel alone, or DeliveryRefused when a retry would repeat it. A send
+    that takes longer than timeout seconds counts as failed; with no
+    timeout, send() must bound its own time.
+
+    In digest mode only channels that take digests get them; the others
+    are sent every notification as it happens.
+    """
+
+    takes_digests = False
+
+    def __init__(self, name, timeout):
+        self.name = name
+        self.timeout = timeout
+        self.metrics = ChannelMetrics()
+
+    def bind(self, fetcher):
+        """Give the channel the monitor's HTTP client, if it needs one."""
+
+    async def send(self, notification, config):
+        """Deliver one notification."""
+        raise NotImplementedError
+
+    async def deliver(self, notification, config):
+        """Send with the channel's timeout, recording latency and failures."""
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(self.send(notification, config),
+                                   self.timeout)
+        except (asyncio.TimeoutError, TimeoutError):
+            self.metrics.timeouts += 1
+            self.metrics.failed += 1
+            if self.timeout is None:
+                raise
+            raise TimeoutError(
+                f"{self.name} timed out after {self.timeout}s") from None
+        except Exception:
+            self.metrics.failed += 1
+            raise
+        finally:
+            self.metrics.latency.record(time.perf_counter() - started)
+        self.metrics.sent += 1
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.name!r})"
+
+
+class SMTPChannel(Channel):
+    """
+    Sends notifications as email through the pooled SMTP connections, as
+    one message to all of their recipients.
+
+    The send runs in a worker thread that cannot be cancelled, so it has no
+    timeout of its own: abandoning it could report a failure for a message
+    that still goes out, and its retry would send it twice. The SMTP pool
+    bounds it instead, with config.smtp_timeout on every socket operation.
+    """
+
+    takes_digests = True
+
+    def __init__(self, name="email", send_email=send_notification_email):
+        super().__init__(name, None)
+        self.send_email = send_email
+
+    async def send(self, notification, config):
+        refused = await asyncio.to_thread(
+            self.send_email,
+            notification.subject,
+            notification.body,
+            config,
+            message_id=notification.message_id,
+            recipients=notification.recipients,
+            url=notification.url,
+            diff=notification.diff,
+        )
+        if refused:
+            raise DeliveryRefused("refused for " + ", ".join(
+                f"{address} ({code} {reply.decode(errors='replace')})"
+                for address, (code, reply) in refused.items()))
+
+
+class WebhookChannel(Channel):
+    """
+    POSTs notifications as JSON to an HTTP endpoint over the monitor's
+    shared aiohttp session. Any response other than 2xx is a failure.
+    """
+
+    def __init__(self, url, name="webhook", headers=None, timeout=10):
+        super().__init__(name, timeout)
+        self.url = url
+        self.headers = headers
+        self.fetcher = None
+
+    def bind(self, fetcher):
+        self.fetcher = fetcher
+
+    async def send(self, notification, config):
+        del config  # The payload does not depend on the configuration.
+        if self.fetcher is None:
+            raise RuntimeError(f"{self.name} has no HTTP client")
+        result = await self.fetcher.post_json(
+            self.url,
+            {
+                "message_id": notification.message_id,
+                "subject": notification.subject,
+                "body": notification.body,
+                "url": notification.url,
+                "diff": notification.diff,
+                "created_at": notification.created_at,
+            },
+            headers=self.headers,
+            timeout=self.timeout,
+        )
+        if result.error is not None:
+            raise result.error
+        if not 200 <= result.status < 300:
+            raise RuntimeError(f"{self.url} answered HTTP {result.status}")
+
+
+class FileChannel(Channel):
+    """
+    Appends notifications to a local file, one per line: as JSON objects in
+    jsonl format, or as RFC 3164 syslog lines in syslog format.
+    """
+
+    def __init__(self, path, name="file", file_format="jsonl", timeout=5):
+        if file_format not in FILE_FORMATS:
+            raise ValueError(
+                f"Unknown file format {file_format!r}, "
+                f"expected one of {', '.join(FILE_FORMATS)}")
+        super().__init__(name, timeout)
+        self.path = path
+        self.file_format = file_format
+        self._lock = threading.Lock()
+
+    def format(self, notification):
+        """Return the line written for a notification."""
+        if self.file_format == "jsonl":
+            return json.dumps({
+                "message_id": notification.message_id,
+                "subject": notification.subject,
+                "body": notification.body,
+                "url": notification.url,
+                "diff": notification.diff,
+                "created_at": notification.created_at,
+            })
+        stamp = time.strftime("%b %d %H:%M:%S",
+                              time.localtime(notification.created_at))
+        body = " ".join(
+            f"{notification.body} {notification.diff or ''}".split())
+        return (f"<{_SYSLOG_PRIORITY}>{stamp} {socket.gethostname()} "
+                f"changecatcher: {notification.subject}: {body}")
+
+    def _append(self, line):
+        with self._lock, open(self.path, "a", encoding="utf-8") as sink:
+            sink.write(line + "\n")
+
+    async def send(self, notification, config):
+        del config  # The line does not depend on the configuration.
+        await asyncio.to_thread(self._append, self.format(notification))
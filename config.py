@@ -1,7 +1,11 @@
 """Configuration module."""
 import os
+import sys
 from dotenv import load_dotenv
 
+from fingerprint import DEFAULT_ALGORITHM
+from watch import Watch
+
 
 class Config:
     """Configuration class."""
@@ -16,7 +20,41 @@ class Config:
         url=None,
         keywords=None,
         interval=None,
-        timeout=None
+        timeout=None,
+        watches=None,
+        max_connections=None,
+        max_connections_per_host=None,
+        smtp_pool_size=None,
+        smtp_starttls=None,
+        smtp_timeout=None,
+        outbox_size=None,
+        outbox_workers=None,
+        outbox_policy=None,
+        state_path=None,
+        state_batch_size=None,
+        max_concurrent_checks=None,
+        status_interval=None,
+        schedule_mode=None,
+        overrun_policy=None,
+        display=None,
+        display_refresh=None,
+        fingerprint_algorithm=None,
+        diff_mode=None,
+        diff_algorithm=None,
+        diff_timeout=None,
+        diff_max_bytes=None,
+        normalizer=None,
+        keyword_realert_interval=None,
+        fetch_failure_threshold=None,
+        missing_failure_threshold=None,
+        fetch_alert_window=None,
+        missing_alert_window=None,
+        digest_window=None,
+        digest_max_events=None,
+        email_template=None,
+        email_style=None,
+        template_cache_dir=None,
+        channels=None,
     ):
         load_dotenv()
         self.smtp_server = self._get_config(
@@ -26,13 +64,76 @@ class Config:
         self.username = self._get_config("USERNAME", username, "Enter email username: ")
         self.password = self._get_config("PASSWORD", password, "Enter email password: ")
         self.sender = self._get_config("SENDER", sender, "Enter sender email address: ")
-        self.recipient = self._get_config(
-            "RECIPIENT", recipient, "Enter recipient email address: "
+        recipient = self._get_config(
+            "RECIPIENT", recipient, "Enter recipient email addresses: "
         )
+        # A comma separated string or a list of addresses. Every address
+        # receives the same message, sent once with one RCPT per address.
+        if isinstance(recipient, str):
+            recipient = recipient.split(",")
+        self.recipients = list(dict.fromkeys(
+            address.strip() for address in recipient if address.strip()))
+        self.recipient = ", ".join(self.recipients)
         self.url = url or "https://www.castleparty.com/bilety.html"
         self.keywords = keywords if keywords is not None else ["ticket", "bird"]
         self.interval = interval or 1800
         self.timeout = timeout or 5
+        self.normalizer = normalizer
+        self.watches = watches or [
+            Watch(self.url, keywords=self.keywords, interval=self.interval)
+        ]
+        # Watches without a normalizer of their own share the default one.
+        for watch in self.watches:
+            if watch.normalizer is None:
+                watch.normalizer = normalizer
+        self.max_connections = max_connections or 100
+        self.max_connections_per_host = max_connections_per_host or 4
+        self.smtp_pool_size = smtp_pool_size or 2
+        if smtp_starttls is None:
+            smtp_starttls = os.getenv("SMTP_STARTTLS", "true").lower() not in (
+                "0", "false", "no"
+            )
+        self.smtp_starttls = smtp_starttls
+        # Seconds each SMTP operation may take, enforced at the socket.
+        self.smtp_timeout = smtp_timeout or 30
+        self.outbox_size = outbox_size or 1000
+        self.outbox_workers = outbox_workers or 2
+        self.outbox_policy = outbox_policy or "spill"
+        self.state_path = state_path or "changecatcher.db"
+        self.state_batch_size = state_batch_size or 500
+        self.max_concurrent_checks = max_concurrent_checks or 500
+        self.status_interval = status_interval or 60
+        self.schedule_mode = schedule_mode or "fixed-rate"
+        self.overrun_policy = overrun_policy or "coalesce"
+        self.display = sys.stdout.isatty() if display is None else display
+        self.display_refresh = display_refresh or 1.0
+        self.fingerprint_algorithm = fingerprint_algorithm or DEFAULT_ALGORITHM
+        self.diff_mode = diff_mode or "dom"
+        self.diff_algorithm = diff_algorithm or "myers"
+        self.diff_timeout = diff_timeout or 2.0
+        self.diff_max_bytes = diff_max_bytes or 2_000_000
+        # Seconds before a keyword that is still present is alerted again;
+        # None alerts only when keywords appear or disappear.
+        self.keyword_realert_interval = keyword_realert_interval
+        # A fetch failure is alerted after this many failed checks in a row,
+        # so short outages stay quiet; a missing element right away.
+        self.fetch_failure_threshold = fetch_failure_threshold or 3
+        self.missing_failure_threshold = missing_failure_threshold or 1
+        # Seconds between summaries while an incident lasts.
+        self.fetch_alert_window = fetch_alert_window or 3600
+        self.missing_alert_window = missing_alert_window or 3600
+        # Seconds to collect notifications into one digest email per
+        # recipient; None sends every notification on its own.
+        self.digest_window = digest_window
+        self.digest_max_events = digest_max_events or 100
+        # None uses the email_template.html and email_style.css shipped
+        # next to the code; a cache directory keeps compiled templates.
+        self.email_template = email_template
+        self.email_style = email_style
+        self.template_cache_dir = (template_cache_dir
+                                   or os.getenv("TEMPLATE_CACHE_DIR"))
+        # Notification channels, see channels.py; None sends email only.
+        self.channels = channels
 
     def _get_config(self, env_var, default, prompt):
         """Helper method to get a value from an environment variable or user input."""
@@ -0,0 +1,308 @@
+"""
+differ.py
+"""
+import html
+import re
+import time
+
+from merkle import build_tree, changed_blocks, find_node, format_path
+
+DIFF_ALGORITHMS = ("myers", "patience")
+
+DIFF_MODES = ("dom", "line", "word")
+
+CONTEXT_TOKENS = 3
+
+_LINE_TOKENS = re.compile(r"<[^>]*>|[^<]+")
+
+_WORD_TOKENS = re.compile(r"<[^>]*>|\s+|\w+|[^<\w\s]")
+
+
+class DiffTooLarge(Exception):
+    """Raised when the inputs or the edit script exceed the size caps."""
+
+
+class DiffTimeout(Exception):
+    """Raised when a diff does not finish before its deadline."""
+
+
+def tokenize(markup, granularity="line"):
+    """
+    Split markup into diff tokens. A line is a tag or a run of text between
+    tags, since extracted markup rarely has line breaks; word granularity
+    also splits text into words, spaces and punctuation.
+    """
+    pattern = _WORD_TOKENS if granularity == "word" else _LINE_TOKENS
+    return pattern.findall(markup)
+
+
+class _Budget:
+    """
+    Deadline and edit distance cap shared by one diff.
+    """
+
+    def __init__(self, timeout, max_edits):
+        self.deadline = time.monotonic() + timeout
+        self.max_edits = max_edits
+
+    def check(self):
+        if time.monotonic() > self.deadline:
+            raise DiffTimeout("diff timed out")
+
+
+def _myers(a, b, a0, a1, b0, b1, budget, out):
+    """
+    Append the (op, i1, i2, j1, j2) opcodes turning a[a0:a1] into b[b0:b1],
+    found with Myers' O((N+M)D) greedy algorithm.
+    """
+    n, m = a1 - a0, b1 - b0
+    if not n or not m:
+        if n:
+            out.append(("delete", a0, a1, b0, b0))
+        elif m:
+            out.append(("insert", a0, a0, b0, b1))
+        return
+    offset = n + m + 1
+    v = [0] * (2 * offset + 2)
+    trace = []
+    for d in range(n + m + 1):
+        if d > budget.max_edits:
+            raise DiffTooLarge(f"more than {budget.max_edits} edits")
+        if d % 64 == 0:
+            budget.check()
+        # Only diagonals -d-1..d+1 are read back, so keep just that band.
+        trace.append(v[offset - d - 1:offset + d + 2])
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and v[offset + k - 1] < v[offset + k + 1]):
+                x = v[offset + k + 1]
+            else:
+                x = v[offset + k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[a0 + x] == b[b0 + y]:
+                x += 1
+                y += 1
+            v[offset + k] = x
+            if x >= n and y >= m:
+                _backtrack(trace, n, m, a0, b0, out)
+                return
+
+
+def _backtrack(trace, x, y, a0, b0, out):
+    """Walk the saved frontiers back from (x, y) and emit opcodes in order."""
+    ops = []
+    for d in range(len(trace) - 1, -1, -1):
+        v = trace[d]
+        band = d + 1
+        k = x - y
+        if k == -d or (k != d and v[band + k - 1] < v[band + k + 1]):
+            prev_k = k + 1
+        else:
+            prev_k = k - 1
+        prev_x = v[band + prev_k] if d else 0
+        prev_y = prev_x - prev_k if d else 0
+        while x > prev_x and y > prev_y:
+            x -= 1
+            y -= 1
+            ops.append(("equal", a0 + x, a0 + x + 1, b0 + y, b0 + y + 1))
+        if d:
+            if x == prev_x:
+                ops.append(("insert", a0 + x, a0 + x, b0 + prev_y, b0 + y))
+            else:
+                ops.append(("delete", a0 + prev_x, a0 + x, b0 + y, b0 + y))
+        x, y = prev_x, prev_y
+    out.extend(reversed(ops))
+
+
+def _unique_positions(tokens, start, end):
+    seen = {}
+    for index in range(start, end):
+        token = tokens[index]
+        seen[token] = None if token in seen else index
+    return {token: index for token, index in seen.items() if index is not None}
+
+
+def _patience_anchors(a, b, a0, a1, b0, b1):
+    """
+    Return (i, j) pairs of tokens unique on both sides, forming their
+    longest common subsequence, found by patience sorting.
+    """
+    in_a = _unique_positions(a, a0, a1)
+    in_b = _unique_positions(b, b0, b1)
+    candidates = [(in_a[token], j) for token, j in in_b.items()
+                  if token in in_a]
+    candidates.sort()
+    piles = []
+    back = {}
+    for i, j in candidates:
+        low, high = 0, len(piles)
+        while low < high:
+            middle = (low + high) // 2
+            if piles[middle][1] < j:
+                low = middle + 1
+            else:
+                high = middle
+        back[(i, j)] = piles[low - 1] if low else None
+        if low == len(piles):
+            piles.append((i, j))
+        else:
+            piles[low] = (i, j)
+    anchors = []
+    node = piles[-1] if piles else None
+    while node is not None:
+        anchors.append(node)
+        node = back[node]
+    return anchors[::-1]
+
+
+def _patience(a, b, a0, a1, b0, b1, budget, out):
+    """
+    Append opcodes for a[a0:a1] -> b[b0:b1], anchoring on tokens that are
+    unique on both sides and using Myers between anchors without any.
+    """
+    budget.check()
+    while a0 < a1 and b0 < b1 and a[a0] == b[b0]:
+        out.append(("equal", a0, a0 + 1, b0, b0 + 1))
+        a0 += 1
+        b0 += 1
+    suffix = []
+    while a1 > a0 and b1 > b0 and a[a1 - 1] == b[b1 - 1]:
+        a1 -= 1
+        b1 -= 1
+        suffix.append(("equal", a1, a1 + 1, b1, b1 + 1))
+    anchors = _patience_anchors(a, b, a0, a1, b0, b1)
+    if not anchors:
+        _myers(a, b, a0, a1, b0, b1, budget, out)
+    else:
+        for i, j in anchors:
+            _patience(a, b, a0, i, b0, j, budget, out)
+            out.append(("equal", i, i + 1, j, j + 1))
+            a0, b0 = i + 1, j + 1
+        _patience(a, b, a0, a1, b0, b1, budget, out)
+    out.extend(reversed(suffix))
+
+
+def _merge(ops):
+    """Join adjacent opcodes of the same kind."""
+    merged = []
+    for op in ops:
+        if merged and merged[-1][0] == op[0]:
+            previous = merged[-1]
+            merged[-1] = (op[0], previous[1], op[2], previous[3], op[4])
+        else:
+            merged.append(op)
+    return merged
+
+
+def diff_tokens(a, b, algorithm="myers", timeout=2.0, max_edits=1000):
+    """
+    Return the opcodes that turn token list a into b, as difflib-style
+    (op, i1, i2, j1, j2) tuples with op one of equal, delete and insert.
+    Raises DiffTimeout after timeout seconds and DiffTooLarge when more
+    than max_edits tokens differ.
+    """
+    if algorithm not in DIFF_ALGORITHMS:
+        raise ValueError(
+            f"Unknown diff algorithm {algorithm!r}, "
+            f"expected one of {', '.join(DIFF_ALGORITHMS)}")
+    budget = _Budget(timeout, max_edits)
+    ops = []
+    if algorithm == "patience":
+        _patience(a, b, 0, len(a), 0, len(b), budget, ops)
+    else:
+        # Strip the common prefix and suffix before the quadratic part.
+        start = 0
+        while start < min(len(a), len(b)) and a[start] == b[start]:
+            start += 1
+        end = 0
+        while (end < min(len(a), len(b)) - start
+               and a[-1 - end] == b[-1 - end]):
+            end += 1
+        if start:
+            ops.append(("equal", 0, start, 0, start))
+        _myers(a, b, start, len(a) - end, start, len(b) - end, budget, ops)
+        if end:
+            ops.append(("equal", len(a) - end, len(a), len(b) - end, len(b)))
+    return _merge(ops)
+
+
+def render_html(a, b, ops, context=CONTEXT_TOKENS, max_chars=20_000):
+    """
+    Render opcodes as compact HTML: deleted tokens in <del>, inserted ones
+    in <ins>, and only context tokens around each change, with the rest of
+    the unchanged markup elided.
+    """
+    out = []
+    length = 0
+    for index, (op, i1, i2, j1, j2) in enumerate(ops):
+        if op == "equal":
+            tokens = a[i1:i2]
+            head = tokens[:context] if index else []
+            tail = tokens[-context:] if index < len(ops) - 1 else []
+            if len(tokens) > len(head) + len(tail):
+                piece = (html.escape("".join(head)) + " … " +
+                         html.escape("".join(tail)))
+            else:
+                piece = html.escape("".join(tokens))
+        elif op == "delete":
+            piece = f"<del>{html.escape(''.join(a[i1:i2]))}</del>"
+        else:
+            piece = f"<ins>{html.escape(''.join(b[j1:j2]))}</ins>"
+        length += len(piece)
+        if length > max_chars:
+            out.append(" … (diff truncated)")
+            break
+        out.append(piece)
+    return "<pre style=\"white-space:pre-wrap\">" + "".join(out) + "</pre>"
+
+
+def diff_markup(old, new, granularity="line", algorithm="myers", timeout=2.0,
+                max_edits=1000):
+    """Return the rendered token diff of two markup strings."""
+    a = tokenize(old, granularity)
+    b = tokenize(new, granularity)
+    return render_html(a, b, diff_tokens(a, b, algorithm, timeout, max_edits))
+
+
+class BlockDiff:
+    """
+    A changed block of a DOM-aware diff, with its rendered HTML diff.
+    """
+
+    def __init__(self, path, kind, diff):
+        self.path = path
+        self.kind = kind
+        self.diff = diff
+
+
+def diff_blocks(old, new, blocks=None, granularity="word", algorithm="myers",
+                timeout=2.0, max_edits=1000):
+    """
+    Diff two markup strings element by element. blocks are the changed
+    blocks of new, as returned by merkle.changed_blocks(); they are
+    computed from old when not given. Each changed element is diffed on its
+    own, so an edit deep in a big section is shown without the rest.
+    """
+    deadline = time.monotonic() + timeout
+    old_tree = build_tree(old)
+    if blocks is None:
+        blocks = changed_blocks(old_tree, build_tree(new))
+    diffs = []
+    for block in blocks:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise DiffTimeout("diff timed out")
+        if block.kind == "added":
+            markup = new[block.node.start:block.node.end]
+            diff = f"<ins>{html.escape(markup)}</ins>"
+        else:
+            old_node = find_node(old_tree, block.old_path)
+            old_markup = (old[old_node.start:old_node.end]
+                          if old_node is not None else "")
+            if block.kind == "removed":
+                diff = f"<del>{html.escape(old_markup)}</del>"
+            else:
+                diff = diff_markup(
+                    old_markup, new[block.node.start:block.node.end],
+                    granularity, algorithm, remaining, max_edits)
+        diffs.append(BlockDiff(format_path(block.path), block.kind, diff))
+    return diffs
@@ -0,0 +1,171 @@
+"""
+digest.py
+"""
+import asyncio
+import contextlib
+import hashlib
+import html
+import time
+
+from logger import Logger
+
+logger = Logger.setup_logger()
+
+
+class DigestMetrics:
+    """
+    Counters of the digest batcher.
+    """
+
+    def __init__(self):
+        self.events = 0
+        self.duplicates = 0
+        self.digests = 0
+        self.largest = 0
+
+    def __str__(self):
+        return (
+            f"events={self.events} duplicates={self.duplicates} "
+            f"digests={self.digests} largest={self.largest}"
+        )
+
+
+def render_digest(events):
+    """
+    Return the subject and HTML body of a digest of (event_id, site,
+    subject, body, created_at) rows, with the events grouped by site in the
+    order each site first appears.
+    """
+    sites = {}
+    for _, site, subject, body, created_at in events:
+        sites.setdefault(site, []).append((subject, body, created_at))
+    parts = []
+    for site, site_events in sites.items():
+        items = "".join(
+            f"<li><strong>{html.escape(subject)}</strong> "
+            f"{time.strftime('%H:%M:%S', time.localtime(created_at))}: "
+            f"{body}</li>"
+            for subject, body, created_at in site_events
+        )
+        parts.append(f"<h4>{html.escape(site)}</h4><ul>{items}</ul>")
+    count = len(events)
+    subject = (f"Digest: {count} event{'s' if count != 1 else ''} on "
+               f"{len(sites)} site{'s' if len(sites) != 1 else ''}")
+    return subject, "".join(parts)
+
+
+class DigestBatcher:
+    """
+    Coalesces notifications into one digest email per recipient and email
+    channel.
+
+    Events are written to the state store, so they can commit together
+    with the watch state that caused them and survive a restart. A
+    recipient's digest goes out window seconds after its oldest waiting
+    event, or as soon as max_events are waiting, and holds at most
+    max_events events. Each digest is enqueued in the notification outbox
+    as a single message on its channel, so it is delivered in one SMTP
+    transaction with the usual retries. Recipients whose digests on a
+    channel come out identical, such as the subscribers of the same
+    watches, share one message.
+    """
+
+    def __init__(self, outbox, store, window=300, max_events=100):
+        self.outbox = outbox
+        self.store = store
+        self.window = window
+        self.max_events = max_events
+        self.metrics = DigestMetrics()
+        self._ready = None
+
+    def submit(self, channels, recipients, site, subject, body,
+               message_id=None):
+        """
+        Add an event to the next digest of every recipient on each of the
+        named channels. Returns False when it duplicates a waiting event for
+        all of them.
+        """
+        created_at = time.time()
+        added = 0
+        for channel in channels:
+            for recipient in recipients:
+                added += self.store.add_digest_event(
+                    recipient, site, subject, body,
+                    f"{message_id}:{channel}:{recipient}" if message_id
+                    else None,
+                    created_at,
+                    channel,
+                )
+        self.metrics.duplicates += len(channels) * len(recipients) - added
+        if not added:
+            return False
+        self.metrics.events += added
+        if self._ready is not None:
+            self._ready.set()
+        return True
+
+    def _send(self, due):
+        """
+        Enqueue one digest of the oldest waiting events of each recipient
+        and channel pair, as a single message on a channel for the
+        recipients whose digests are identical. Events of older releases,
+        without a channel, go to every channel.
+        """
+        digests = {}
+        for recipient, channel in due:
+            events = self.store.digest_events(recipient, channel,
+                                              self.max_events)
+            if events:
+                digests.setdefault(
+                    (channel, *render_digest(events)), []
+                ).append((recipient, [event[0] for event in events]))
+        for (channel, subject, body), batch in digests.items():
+            events = ";".join(
+                f"{recipient}:{event_ids[0]}:{event_ids[-1]}"
+                for recipient, event_ids in batch)
+            message_id = hashlib.sha1(
+                f"{channel}|{events}".encode()).hexdigest()
+            with self.store.transaction():
+                self.outbox.submit(subject, body, message_id,
+                                   channels=[channel] if channel else None,
+                                   recipients=[recipient
+                                               for recipient, _ in batch])
+                for _, event_ids in batch:
+                    self.store.delete_digest_events(event_ids)
+            size = len(batch[0][1])
+            self.metrics.digests += 1
+            self.metrics.largest = max(self.metrics.largest, size)
+            logger.info("Digest of %d events queued on %s for %s", size,
+                        channel or "every channel",
+                        ", ".join(recipient for recipient, _ in batch))
+
+    def flush(self, force=False, now=None):
+        """
+        Enqueue the digests that are due, or every waiting event when
+        force is set. Returns when the next digest becomes due, or None.
+        """
+        now = time.time() if now is None else now
+        while True:
+            due = []
+            next_due_at = None
+            for recipient, channel, count, oldest in (
+                    self.store.digest_backlog()):
+                due_at = oldest + self.window
+                if force or count >= self.max_events or due_at <= now:
+                    due.append((recipient, channel))
+                elif next_due_at is None or due_at < next_due_at:
+                    next_due_at = due_at
+            if not due:
+                return next_due_at
+            self._send(due)
+
+    async def run(self):
+        """Send digests as they become due, until cancelled."""
+        self._ready = asyncio.Event()
+        while True:
+            self._ready.clear()
+            next_due_at = self.flush()
+            timeout = (self.window if next_due_at is None
+                       else max(0.0, next_due_at - time.time()))
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._ready.wait(), timeout)
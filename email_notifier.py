@@ -2,21 +2,224 @@
 email_notifier.py
 """
 import smtplib
+import threading
+import time
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 
+from email_renderer import get_renderer
+from logger import Logger
 
-def send_notification_email(subject, email_body, config):
-    """Send email notification with the provided body."""
+logger = Logger.setup_logger()
+
+
+class _PooledConnection:
+    """
+    An SMTP connection together with its usage counters.
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.messages_sent = 0
+        self.released_at = time.monotonic()
+
+    def is_healthy(self):
+        """Check the connection with NOOP."""
+        try:
+            return self.server.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    def close(self):
+        """Close the connection, ignoring errors from an already dead peer."""
+        try:
+            self.server.quit()
+        except (smtplib.SMTPException, OSError):
+            self.server.close()
+
+
+class SMTPConnectionPool:
+    """
+    Pool of logged-in SMTP connections reused across messages.
+
+    Connections idle for longer than max_idle seconds are recycled, ones
+    idle for longer than health_check_after seconds are checked with NOOP
+    before use, and a connection is retired after max_messages messages.
+    A send that finds the server disconnected is retried once on a newly
+    opened connection, never on another idle one that may be just as dead.
+    Every SMTP operation, and the wait for a free connection, is bounded by
+    timeout seconds.
+    """
+
+    def __init__(
+        self,
+        host,
+        port,
+        username,
+        password,
+        size=2,
+        starttls=True,
+        timeout=30,
+        max_idle=240,
+        health_check_after=15,
+        max_messages=100,
+    ):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.health_check_after = health_check_after
+        self.max_messages = max_messages
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._idle = []
+
+    def _connect(self):
+        """Open, secure and authenticate a new connection."""
+        server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            server.ehlo()
+            if self.starttls:
+                server.starttls()
+                server.ehlo()
+            if self.username:
+                server.login(self.username, self.password)
+        except Exception:
+            server.close()
+            raise
+        return _PooledConnection(server)
+
+    def _acquire(self):
+        """Return a usable connection, reusing an idle one when possible."""
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                connection = self._idle.pop()
+            idle_for = time.monotonic() - connection.released_at
+            if idle_for > self.max_idle:
+                connection.close()
+            elif (idle_for > self.health_check_after
+                  and not connection.is_healthy()):
+                connection.server.close()
+            else:
+                return connection
+        return self._connect()
+
+    def _release(self, connection):
+        """Return a connection to the pool, or retire it."""
+        if connection.messages_sent >= self.max_messages:
+            connection.close()
+            return
+        connection.released_at = time.monotonic()
+        with self._lock:
+            self._idle.append(connection)
+
+    def _sendmail(self, connection, sender, recipients, message):
+        """Send on one connection, then return it to the pool or close it."""
+        try:
+            refused = connection.server.sendmail(sender, recipients, message)
+        except smtplib.SMTPServerDisconnected:
+            connection.server.close()
+            raise
+        except Exception:
+            connection.close()
+            raise
+        connection.messages_sent += 1
+        self._release(connection)
+        return refused
+
+    def send(self, sender, recipients, message):
+        """
+        Send one message, reconnecting once if the server went away.
+        Returns the recipients the server refused, as sendmail() does.
+        """
+        if not self._slots.acquire(timeout=self.timeout):
+            raise TimeoutError(
+                f"No SMTP connection free after {self.timeout}s")
+        try:
+            try:
+                return self._sendmail(self._acquire(), sender, recipients,
+                                      message)
+            except smtplib.SMTPServerDisconnected:
+                return self._sendmail(self._connect(), sender, recipients,
+                                      message)
+        finally:
+            self._slots.release()
+
+    def close(self):
+        """Close every idle connection."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_smtp_pool(config):
+    """Return the connection pool for the SMTP account in config."""
+    key = (config.smtp_server, int(config.smtp_port), config.username)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = SMTPConnectionPool(
+                config.smtp_server,
+                int(config.smtp_port),
+                config.username,
+                config.password,
+                size=config.smtp_pool_size,
+                starttls=config.smtp_starttls,
+                timeout=config.smtp_timeout,
+            )
+            _pools[key] = pool
+        return pool
+
+
+def close_smtp_pools():
+    """Close the connections of every pool."""
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close()
+
+
+def send_notification_email(subject, email_body, config, message_id=None,
+                            recipients=None, url=None, diff=None):
+    """
+    Send email notification with the provided body, and the page url and
+    diff when given, rendered into the email template. A message id makes
+    the Message-ID header stable, so a retried send can be deduplicated.
+
+    The message goes to recipients, or to the configured recipients, in a
+    single SMTP transaction with one RCPT TO per address, so the template
+    is rendered and the message sent once however many people get it.
+    The message still goes to the others when the server refuses some
+    recipients; those are logged and returned, mapped to the server's
+    reply, as sendmail() does.
+    """
+    recipients = recipients or config.recipients
     msg = MIMEMultipart('alternative')
     msg['Subject'] = subject
     msg['From'] = config.sender
-    msg['To'] = config.recipient
+    msg['To'] = ", ".join(recipients)
+    if message_id:
+        domain = config.sender.rpartition("@")[2] or "changecatcher"
+        msg['Message-ID'] = f"<{message_id}@{domain}>"
 
-    html_content = MIMEText(email_body, 'html')
+    html_content = MIMEText(
+        get_renderer(config).render(subject, email_body, url=url, diff=diff),
+        'html')
     msg.attach(html_content)
-    with smtplib.SMTP(config.smtp_server, config.smtp_port) as server:
-        server.ehlo()
-        server.starttls()
-        server.login(config.username, config.password)
-        server.sendmail(config.sender, [config.recipient], msg.as_string())
+    refused = get_smtp_pool(config).send(config.sender, recipients,
+                                         msg.as_string())
+    if refused:
+        logger.warning("Message %s was refused for %s", message_id,
+                       ", ".join(refused))
+    return refused
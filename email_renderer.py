@@ -0,0 +1,154 @@
+"""
+email_renderer.py
+"""
+import os
+import re
+import threading
+import time
+
+from jinja2 import (
+    Environment,
+    FileSystemBytecodeCache,
+    FileSystemLoader,
+    select_autoescape,
+)
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+
+TEMPLATE_PATH = os.path.join(_HERE, "email_template.html")
+
+STYLE_PATH = os.path.join(_HERE, "email_style.css")
+
+_RULE = re.compile(r"([^{}]+)\{([^{}]*)\}")
+
+_START_TAG = re.compile(r"<([a-zA-Z][\w-]*)([^>]*)>")
+
+_CLASS = re.compile(r"""\sclass\s*=\s*(?:"([^"]*)"|'([^']*)')""")
+
+_STYLE = re.compile(r"""\sstyle\s*=\s*(?:"([^"]*)"|'([^']*)')""")
+
+
+def _parse_css(css):
+    """
+    Return the (tag, classes, declarations) rules of a stylesheet with
+    simple selectors: tag, .class and tag.class, possibly grouped by commas.
+    """
+    rules = []
+    for selectors, body in _RULE.findall(re.sub(r"/\*.*?\*/", "", css,
+                                                flags=re.S)):
+        declarations = "; ".join(
+            part.strip() for part in body.split(";") if part.strip())
+        for selector in selectors.split(","):
+            tag, *classes = selector.strip().split(".")
+            if not re.fullmatch(r"[\w-]*", tag) or " " in selector.strip():
+                continue
+            rules.append((tag.lower() or None, frozenset(classes),
+                          declarations))
+    return rules
+
+
+def inline_css(markup, css):
+    """
+    Copy the rules of a stylesheet into the style attribute of the matching
+    start tags of markup, since many mail clients ignore <style> blocks.
+    Declarations already on an element come last, so they still win.
+    """
+    rules = _parse_css(css)
+
+    def inline(match):
+        tag, attributes = match.group(1).lower(), match.group(2)
+        if "{{" in attributes or "{%" in attributes:
+            return match.group()
+        found = _CLASS.search(attributes)
+        classes = set((found.group(1) or found.group(2) or "").split()
+                      if found else ())
+        declarations = [body for rule_tag, rule_classes, body in rules
+                        if rule_tag in (None, tag) and rule_classes <= classes
+                        and (rule_tag or rule_classes)]
+        if not declarations:
+            return match.group()
+        existing = _STYLE.search(attributes)
+        if existing:
+            declarations.append(existing.group(1) or existing.group(2) or "")
+            attributes = (attributes[:existing.start()] +
+                          attributes[existing.end():])
+        style = "; ".join(declarations).replace('"', "'")
+        closing = "/" if attributes.endswith("/") else ""
+        attributes = attributes[:-1] if closing else attributes
+        return f'<{match.group(1)}{attributes} style="{style}"{closing}>'
+
+    return _START_TAG.sub(inline, markup)
+
+
+class _InliningLoader(FileSystemLoader):
+    """
+    Template loader that inlines a stylesheet into every template it loads.
+    """
+
+    def __init__(self, searchpath, style):
+        super().__init__(searchpath)
+        self.style = style
+
+    def get_source(self, environment, template):
+        source, filename, uptodate = super().get_source(environment, template)
+        return inline_css(source, self.style), filename, uptodate
+
+
+class EmailRenderer:
+    """
+    Renders notification emails from email_template.html.
+
+    The stylesheet is read and inlined into the template once, and the
+    template is compiled once into a Template that every render reuses,
+    so a burst of notifications only pays for filling in the context.
+    With a cache directory the compiled bytecode is also kept on disk,
+    so later runs skip compiling.
+    """
+
+    def __init__(self, template_path=None, style_path=None, cache_dir=None):
+        self.template_path = template_path or TEMPLATE_PATH
+        self.style_path = style_path or STYLE_PATH
+        with open(self.style_path, encoding="utf-8") as style_file:
+            self.style = style_file.read()
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        self.environment = Environment(
+            loader=_InliningLoader(os.path.dirname(self.template_path),
+                                   self.style),
+            autoescape=select_autoescape(["html"]),
+            bytecode_cache=(FileSystemBytecodeCache(cache_dir)
+                            if cache_dir else None),
+            auto_reload=False,
+        )
+        self.template = self.environment.get_template(
+            os.path.basename(self.template_path),
+            globals={"style": self.style})
+
+    def render(self, subject, content, url=None, diff=None,
+               current_date=None):
+        """
+        Return the HTML of a notification. content and diff are trusted
+        HTML; subject and url are escaped.
+        """
+        return self.template.render(
+            subject=subject,
+            content=content,
+            url=url,
+            diff=diff,
+            current_date=current_date or time.strftime("%Y-%m-%d %H:%M:%S"),
+        )
+
+
+_renderers = {}
+_renderers_lock = threading.Lock()
+
+
+def get_renderer(config):
+    """Return the renderer for the template files in config."""
+    key = (config.email_template, config.email_style,
+           config.template_cache_dir)
+    with _renderers_lock:
+        renderer = _renderers.get(key)
+        if renderer is None:
+            renderer = _renderers[key] = EmailRenderer(*key)
+        return renderer
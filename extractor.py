@@ -0,0 +1,554 @@
+"""
+extractor.py
+"""
+import codecs
+import re
+import time
+from html.parser import HTMLParser
+
+from bs4 import BeautifulSoup, Comment, NavigableString, SoupStrainer
+
+from logger import Logger
+
+try:
+    import lxml.etree
+    import lxml.html
+except ImportError:
+    lxml = None
+
+try:
+    from selectolax.lexbor import LexborHTMLParser
+except ImportError:
+    LexborHTMLParser = None
+
+logger = Logger.setup_logger()
+
+EXTRACTION_MODES = ("full", "strainer", "stream")
+
+# Extraction mode that keeps the source bytes of the element, see
+# extract_raw_element().
+RAW_MODE = "raw"
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+VOID_ELEMENTS = frozenset((
+    "area", "base", "br", "col", "embed", "hr", "img", "input", "link",
+    "meta", "param", "source", "track", "wbr",
+))
+
+RAW_TEXT_ELEMENTS = frozenset(("script", "style"))
+
+
+def _escape_text(text):
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+
+def _escape_attribute(value):
+    return _escape_text(value).replace('"', "&quot;")
+
+
+def canonicalize(events):
+    """
+    Serialize a stream of element events into the canonical markup.
+
+    Events are ("start", tag, attrs), ("end", tag) and ("text", data)
+    tuples. The output does not depend on which parser produced the events:
+    attributes keep their source order, boolean attributes are written as
+    name="", void elements are self-closed and comments are dropped.
+    """
+    out = []
+    raw_text = 0
+    for event in events:
+        kind = event[0]
+        if kind == "text":
+            out.append(event[1] if raw_text else _escape_text(event[1]))
+        elif kind == "start":
+            tag, attrs = event[1], event[2]
+            out.append("<" + tag)
+            for name, value in attrs:
+                if value is None or value == name:
+                    value = ""
+                out.append(f' {name}="{_escape_attribute(value)}"')
+            out.append("/>" if tag in VOID_ELEMENTS else ">")
+            if tag in RAW_TEXT_ELEMENTS:
+                raw_text += 1
+        elif kind == "end":
+            tag = event[1]
+            if tag in RAW_TEXT_ELEMENTS:
+                raw_text -= 1
+            if tag not in VOID_ELEMENTS:
+                out.append(f"</{tag}>")
+    return "".join(out)
+
+
+class _ElementClosed(Exception):
+    """Raised from inside the tokenizer to stop once the element is closed."""
+
+
+class _ElementLocator(HTMLParser):
+    """
+    Tokenizer that finds the source range of the first element with the
+    given tag and id, without building any tree.
+    """
+
+    def __init__(self, tag, element_id):
+        super().__init__(convert_charrefs=False)
+        self.tag = tag
+        self.element_id = element_id
+        self.start = None
+        self.end = None
+        self._depth = 0
+        self._line_starts = [0]
+        self._fed = 0
+        self._html = ""
+
+    def locate(self, html):
+        """Return the (start, end) offsets of the element in html, or None."""
+        self._html = html
+        return self._run(
+            html[offset:offset + STREAM_CHUNK_SIZE]
+            for offset in range(0, len(html), STREAM_CHUNK_SIZE))
+
+    def locate_bytes(self, body, encoding="utf-8"):
+        """
+        Return the (start, end) byte offsets of the element in body, or
+        None. body must use an ASCII-compatible encoding. Chunks are decoded
+        as Latin-1, which maps every byte to one character, so character
+        offsets are byte offsets and markup is recognised in any such
+        encoding without decoding the page properly.
+        """
+        self._html = body
+        element_id = self.element_id.encode(encoding, errors="replace")
+        self.element_id = element_id.decode("latin-1")
+        begin = self._skip_ahead(body, element_id)
+        self._line_starts = [begin]
+        self._fed = begin
+        view = memoryview(body)
+        return self._run(
+            str(view[offset:offset + STREAM_CHUNK_SIZE], "latin-1")
+            for offset in range(begin, len(body), STREAM_CHUNK_SIZE))
+
+    def _skip_ahead(self, body, element_id):
+        """
+        Return the offset of the first start tag that looks like the
+        element, so tokenizing can begin there. Returns 0 when there is no
+        such tag, or when it might sit inside a comment, script or style.
+        """
+        pattern = (rb"<" + re.escape(self.tag.encode()) +
+                   rb"\b[^>]*?\bid\s*=\s*[\"']?" + re.escape(element_id) +
+                   rb"[\"'\s/>]")
+        match = re.search(pattern, body, re.IGNORECASE)
+        if match is None:
+            return 0
+        begin = match.start()
+        for opener, closer in ((b"<!--", b"-->"), (b"<script", b"</script"),
+                               (b"<style", b"</style")):
+            for variant in (opener, opener.upper()):
+                found = body.rfind(variant, 0, begin)
+                if found != -1 and body.find(closer, found, begin) == -1 and \
+                        body.find(closer.upper(), found, begin) == -1:
+                    return 0
+        return begin
+
+    def _run(self, chunks):
+        """Feed chunks until the element is closed or the document ends."""
+        try:
+            for chunk in chunks:
+                self._track_lines(chunk)
+                self.feed(chunk)
+            self.close()
+        except _ElementClosed:
+            return self.start, self.end
+        if self.start is None:
+            return None
+        # Unclosed element: it runs to the end of the document.
+        return self.start, len(self._html)
+
+    def _track_lines(self, chunk):
+        """Remember where every line starts so positions map to offsets."""
+        index = chunk.find("\n")
+        while index != -1:
+            self._line_starts.append(self._fed + index + 1)
+            index = chunk.find("\n", index + 1)
+        self._fed += len(chunk)
+
+    def _offset(self):
+        """Return the document offset of the token being handled."""
+        lineno, column = self.getpos()
+        return self._line_starts[lineno - 1] + column
+
+    def handle_starttag(self, tag, attrs):
+        if tag != self.tag:
+            return
+        if self.start is not None:
+            self._depth += 1
+        elif dict(attrs).get("id") == self.element_id:
+            self.start = self._offset()
+            self._depth = 1
+
+    def handle_startendtag(self, tag, attrs):
+        if (self.start is None and tag == self.tag
+                and dict(attrs).get("id") == self.element_id):
+            self.start = self._offset()
+            self.end = self.start + len(self.get_starttag_text() or "")
+            raise _ElementClosed
+
+    def handle_endtag(self, tag):
+        if self.start is None or tag != self.tag:
+            return
+        self._depth -= 1
+        if self._depth == 0:
+            if isinstance(self._html, bytes):
+                self.end = self._html.index(b">", self._offset()) + 1
+            else:
+                self.end = self._html.index(">", self._offset()) + 1
+            raise _ElementClosed
+
+
+class RawSection:
+    """
+    The source bytes of an extracted element.
+
+    The bytes stay a memoryview into the response body, so fingerprinting
+    them copies nothing. The text is decoded only when something reads it,
+    such as keyword matching or a notification.
+    """
+
+    def __init__(self, body, start, end, encoding="utf-8"):
+        self.view = memoryview(body)[start:end]
+        self.encoding = encoding
+        self._text = None
+
+    @property
+    def text(self):
+        """Return the element's markup decoded from the source bytes."""
+        if self._text is None:
+            self._text = str(self.view, self.encoding, "replace")
+        return self._text
+
+    def __len__(self):
+        return len(self.view)
+
+    def __str__(self):
+        return self.text
+
+
+class ExtractionBackend:
+    """
+    Base class for the parsers that can extract an element from a page.
+
+    A backend finds the element in its own tree type and reports it as a
+    stream of events; canonicalize() turns those into markup, so backends
+    produce the same output for the same well-formed element.
+    """
+
+    name = None
+    modes = ("full",)
+
+    @classmethod
+    def available(cls) -> bool:
+        """Whether the libraries this backend needs are installed."""
+        return True
+
+    def find(self, html, tag, element_id, mode):
+        """Return the native element with the given tag and id, or None."""
+        raise NotImplementedError
+
+    def iter_events(self, element):
+        """Yield the canonical events of the native element."""
+        raise NotImplementedError
+
+    def extract(self, html, tag, element_id, mode="full"):
+        """Return the canonical markup of the element, or None."""
+        if mode not in self.modes:
+            mode = "full"
+        element = self.find(html, tag, element_id, mode)
+        if element is None:
+            return None
+        return canonicalize(self.iter_events(element))
+
+
+class HtmlParserBackend(ExtractionBackend):
+    """
+    BeautifulSoup on the pure-Python html.parser, always available.
+    """
+
+    name = "html.parser"
+    modes = EXTRACTION_MODES
+
+    def find(self, html, tag, element_id, mode):
+        if mode == "stream":
+            span = _ElementLocator(tag, element_id).locate(html)
+            if span is None:
+                return None
+            start, end = span
+            html = html[start:end]
+            soup = self._parse(html)
+        elif mode == "strainer":
+            strainer = SoupStrainer(tag, attrs={"id": element_id})
+            soup = self._parse(html, parse_only=strainer)
+        else:
+            soup = self._parse(html)
+        return soup.find(tag, {"id": element_id})
+
+    @staticmethod
+    def _parse(html, **kwargs):
+        return BeautifulSoup(html, "html.parser",
+                             multi_valued_attributes=None, **kwargs)
+
+    def iter_events(self, element):
+        stack = [element]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, tuple):
+                yield node
+            elif isinstance(node, Comment):
+                continue
+            elif isinstance(node, NavigableString):
+                yield ("text", str(node))
+            else:
+                yield ("start", node.name, list(node.attrs.items()))
+                stack.append(("end", node.name))
+                stack.extend(reversed(node.contents))
+
+
+class LxmlBackend(ExtractionBackend):
+    """
+    libxml2's HTML parser through lxml, used when lxml is installed.
+    """
+
+    name = "lxml"
+    modes = ("full", "stream")
+
+    @classmethod
+    def available(cls):
+        return lxml is not None
+
+    def find(self, html, tag, element_id, mode):
+        assert lxml is not None, "lxml is not installed"
+        if mode == "stream":
+            return self._find_streamed(html, tag, element_id)
+        root = lxml.html.document_fromstring(html)
+        found = root.xpath(f"//{tag}[@id=$element_id]", element_id=element_id)
+        return found[0] if found else None
+
+    @staticmethod
+    def _find_streamed(html, tag, element_id):
+        """Feed the pull parser until the element has been closed."""
+        assert lxml is not None, "lxml is not installed"
+        parser = lxml.etree.HTMLPullParser(events=("start", "end"))
+        target = None
+        for offset in range(0, len(html), STREAM_CHUNK_SIZE):
+            parser.feed(html[offset:offset + STREAM_CHUNK_SIZE])
+            for event, element in parser.read_events():
+                if element.tag != tag:
+                    continue
+                if target is None:
+                    if event == "start" and element.get("id") == element_id:
+                        target = element
+                elif event == "end" and element is target:
+                    return target
+        parser.close()
+        return target
+
+    def iter_events(self, element):
+        stack = [element]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, tuple):
+                yield node
+                continue
+            if not isinstance(node.tag, str):
+                # Comments and processing instructions.
+                continue
+            yield ("start", node.tag, list(node.attrib.items()))
+            children = []
+            if node.text:
+                children.append(("text", node.text))
+            for child in node:
+                children.append(child)
+                if child.tail:
+                    children.append(("text", child.tail))
+            stack.append(("end", node.tag))
+            stack.extend(reversed(children))
+
+
+class SelectolaxBackend(ExtractionBackend):
+    """
+    The lexbor C parser through selectolax, used when selectolax is installed.
+    """
+
+    name = "selectolax"
+
+    @classmethod
+    def available(cls):
+        return LexborHTMLParser is not None
+
+    def find(self, html, tag, element_id, mode):
+        del mode  # lexbor always parses the whole document.
+        assert LexborHTMLParser is not None, "selectolax is not installed"
+        quoted = element_id.replace("\\", "\\\\").replace('"', '\\"')
+        return LexborHTMLParser(html).css_first(f'{tag}[id="{quoted}"]')
+
+    def iter_events(self, element):
+        stack = [element]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, tuple):
+                yield node
+                continue
+            tag = node.tag
+            if tag == "-text":
+                yield ("text", node.text_content)
+                continue
+            if tag.startswith("-"):
+                continue
+            yield ("start", tag, list(node.attributes.items()))
+            stack.append(("end", tag))
+            children = []
+            child = node.child
+            while child is not None:
+                children.append(child)
+                child = child.next
+            stack.extend(reversed(children))
+
+
+BACKENDS = {
+    backend.name: backend
+    for backend in (HtmlParserBackend, LxmlBackend, SelectolaxBackend)
+}
+
+DEFAULT_BACKEND = HtmlParserBackend.name
+
+# Backend name that picks the fastest available backend, see select_backend().
+AUTO_BACKEND = "auto"
+
+_selected_backend = None
+
+
+def available_backends():
+    """Return the names of the backends usable on this machine."""
+    return [name for name, backend in BACKENDS.items() if backend.available()]
+
+
+def sample_page(size):
+    """Build a synthetic ticketing page of roughly the given size in bytes."""
+    row = (
+        '<tr class="offer"><td><a href="/event?id={0}">Event {0}</a></td>'
+        '<td data-price="{0}">{0}.00 PLN</td><td><span>available</span></td>'
+        "</tr>\n"
+    )
+    head = "<html><head><title>Bilety</title></head><body><table>\n"
+    section = (
+        '<section id="welcome"><h2>Tickets</h2>'
+        "<p>Ticket sale starts soon.</p></section>\n"
+    )
+    rows = []
+    length = len(head) + len(section)
+    index = 0
+    while length < size:
+        rows.append(row.format(index))
+        length += len(rows[-1])
+        index += 1
+    half = len(rows) // 2
+    return (head + "".join(rows[:half]) + "</table>" + section + "<table>" +
+            "".join(rows[half:]) + "</table></body></html>")
+
+
+def probe_backends(size=200_000, rounds=3):
+    """
+    Time every available backend on a sample page and return
+    (name, seconds) pairs, fastest first.
+
+    Backends whose output on the sample page differs from the default
+    backend are left out. The sample is well-formed markup, so agreeing on
+    it does not mean agreeing on every page.
+    """
+    html = sample_page(size)
+    expected = BACKENDS[DEFAULT_BACKEND]().extract(html, "section", "welcome")
+    timings = []
+    for name in available_backends():
+        backend = BACKENDS[name]()
+        mode = "stream" if "stream" in backend.modes else "full"
+        if backend.extract(html, "section", "welcome", mode) != expected:
+            logger.warning("Parser backend %s disagrees with %s, skipping it.",
+                           name, DEFAULT_BACKEND)
+            continue
+        best = None
+        for _ in range(rounds):
+            started = time.perf_counter()
+            backend.extract(html, "section", "welcome", mode)
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        timings.append((name, best))
+    return sorted(timings, key=lambda timing: timing[1])
+
+
+def select_backend(name=None):
+    """
+    Return the backend with the given name, html.parser when no name is
+    given, or the fastest one on this machine for "auto". The probe runs
+    once per process.
+
+    The parsers repair malformed markup differently: they disagree on
+    whitespace-only text, implied <tbody> and unclosed elements, among
+    others. Switching a watch to another backend can therefore change its
+    fingerprint once, which is why the faster backends are only used when
+    asked for by name or with "auto".
+    """
+    global _selected_backend
+    if name is None:
+        name = DEFAULT_BACKEND
+    if name != AUTO_BACKEND:
+        backend = BACKENDS.get(name)
+        if backend is None or not backend.available():
+            raise ValueError(f"Parser backend {name!r} is not available")
+        return backend()
+    if _selected_backend is None:
+        timings = probe_backends()
+        _selected_backend = BACKENDS[timings[0][0]]()
+        logger.info(
+            "Selected parser backend %s (%s)",
+            _selected_backend.name,
+            ", ".join(f"{n} {s * 1000:.1f} ms" for n, s in timings),
+        )
+    return _selected_backend
+
+
+def extract_raw_element(body, element_id, tag="section", encoding="utf-8"):
+    """
+    Find the element with the given tag and id in the raw response body.
+
+    Returns a RawSection over the element's source bytes, or None when it
+    is not present. Unlike extract_element() the markup is not
+    canonicalized, so formatting-only edits inside the element count as
+    changes.
+    """
+    if codecs.lookup(encoding).name.startswith(("utf-16", "utf-32")):
+        # Not ASCII-compatible, so markup bytes cannot be found directly.
+        body = body.decode(encoding, errors="replace").encode()
+        encoding = "utf-8"
+    span = _ElementLocator(tag, element_id).locate_bytes(body, encoding)
+    if span is None:
+        return None
+    return RawSection(body, *span, encoding=encoding)
+
+
+def extract_element(html, element_id, tag="section", mode="full",
+                    backend=None):
+    """
+    Extract the element with the given tag and id from html.
+
+    Returns the canonical markup of the element, or None when it is not
+    present. Every mode of a backend produces the same markup, so hashes
+    stay comparable when a watch switches modes; see select_backend() on
+    switching backends. Modes a backend does not support fall back to full
+    parsing.
+    """
+    if mode not in EXTRACTION_MODES:
+        raise ValueError(
+            f"Unknown extraction mode {mode!r}, "
+            f"expected one of {', '.join(EXTRACTION_MODES)}")
+    if not isinstance(backend, ExtractionBackend):
+        backend = select_backend(backend)
+    return backend.extract(html, tag, element_id, mode)
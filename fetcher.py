@@ -0,0 +1,198 @@
+"""
+fetcher.py
+"""
+import asyncio
+import codecs
+from collections import defaultdict
+from urllib.parse import urlsplit
+
+import aiohttp
+
+
+class FetchResult:
+    """
+    Outcome of a single HTTP fetch.
+    """
+
+    def __init__(self, url, status=None, body=b"", headers=None, error=None):
+        self.url = url
+        self.status = status
+        self.body = body
+        self.headers = headers or {}
+        self.error = error
+
+    @property
+    def not_modified(self):
+        """Whether the server confirmed the cached copy is still current."""
+        return self.error is None and self.status == 304
+
+    @property
+    def etag(self):
+        """Return the ETag validator of the response, if any."""
+        return self.headers.get("ETag")
+
+    @property
+    def last_modified(self):
+        """Return the Last-Modified validator of the response, if any."""
+        return self.headers.get("Last-Modified")
+
+    @property
+    def ok(self):
+        """Whether the fetch returned a usable 200 response."""
+        return self.error is None and self.status == 200
+
+    @property
+    def charset(self):
+        """Return the charset announced by the server, or utf-8."""
+        content_type = self.headers.get("Content-Type", "")
+        for param in content_type.split(";")[1:]:
+            key, _, value = param.strip().partition("=")
+            if key.lower() == "charset" and value:
+                try:
+                    return codecs.lookup(value.strip("\"'")).name
+                except LookupError:
+                    break
+        return "utf-8"
+
+    @property
+    def text(self):
+        """Return the body decoded with the charset announced by the server."""
+        return self.body.decode(self.charset, errors="replace")
+
+
+class HostStats:
+    """
+    Revalidation counters for a single host.
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.conditional = 0
+        self.not_modified = 0
+
+    @property
+    def hit_rate(self):
+        """Share of conditional requests answered with 304 Not Modified."""
+        if not self.conditional:
+            return 0.0
+        return self.not_modified / self.conditional
+
+
+class AsyncFetcher:
+    """
+    Concurrent page fetcher sharing one aiohttp session across all watches.
+
+    In-flight requests are bounded globally and per host. A request first
+    waits for a slot on its own host and only then takes a global slot, so
+    a slow host queues up behind itself instead of starving every other
+    check.
+    """
+
+    def __init__(self, max_connections=100, max_connections_per_host=4,
+                 timeout=5):
+        self.max_connections = max_connections
+        self.max_connections_per_host = max_connections_per_host
+        self.timeout = timeout
+        self._session = None
+        self._global_slots = asyncio.Semaphore(max_connections)
+        self._host_slots = defaultdict(
+            lambda: asyncio.Semaphore(self.max_connections_per_host))
+        self.host_stats = defaultdict(HostStats)
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def open(self):
+        """Create the shared session and concurrency limits."""
+        if self._session is not None:
+            return
+        connector = aiohttp.TCPConnector(
+            limit=self.max_connections,
+            limit_per_host=self.max_connections_per_host,
+            ttl_dns_cache=300,
+        )
+        self._session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+        )
+        self._global_slots = asyncio.Semaphore(self.max_connections)
+        self._host_slots = defaultdict(
+            lambda: asyncio.Semaphore(self.max_connections_per_host))
+
+    @property
+    def session(self):
+        """Return the shared session, which open() creates."""
+        if self._session is None:
+            raise RuntimeError("The fetcher is not open")
+        return self._session
+
+    async def close(self):
+        """Close the shared session."""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def fetch(self, url, etag=None, last_modified=None):
+        """
+        Fetch the given url and return a FetchResult.
+
+        When validators from a previous response are given the request is
+        sent as a conditional GET, and a 304 answer carries no body.
+        """
+        host = urlsplit(url).netloc.lower()
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+
+        stats = self.host_stats[host]
+        stats.requests += 1
+        if headers:
+            stats.conditional += 1
+
+        async with self._host_slots[host], self._global_slots:
+            try:
+                async with self.session.get(url, headers=headers) as response:
+                    if response.status == 304:
+                        stats.not_modified += 1
+                        return FetchResult(url, 304, b"", response.headers)
+                    body = await response.read()
+                    return FetchResult(url, response.status, body,
+                                       response.headers)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+                return FetchResult(url, error=error)
+
+    async def post_json(self, url, payload, headers=None, timeout=None):
+        """
+        POST payload as JSON to url over the shared session and return a
+        FetchResult. timeout overrides the session timeout in seconds.
+        """
+        host = urlsplit(url).netloc.lower()
+        kwargs = {"json": payload, "headers": headers}
+        if timeout is not None:
+            kwargs["timeout"] = aiohttp.ClientTimeout(total=timeout)
+        async with self._host_slots[host], self._global_slots:
+            try:
+                async with self.session.post(url, **kwargs) as response:
+                    body = await response.read()
+                    return FetchResult(url, response.status, body,
+                                       response.headers)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+                return FetchResult(url, error=error)
+
+    async def fetch_all(self, urls):
+        """Fetch all urls concurrently, returning results in the same order."""
+        return await asyncio.gather(*(self.fetch(url) for url in urls))
+
+    def revalidation_report(self):
+        """Return the revalidation hit rate of every host seen so far."""
+        return {
+            host: stats.hit_rate
+            for host, stats in sorted(self.host_stats.items())
+            if stats.conditional
+        }
@@ -0,0 +1,95 @@
+"""
+fingerprint.py
+"""
+import hashlib
+
+from logger import Logger
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+logger = Logger.setup_logger()
+
+
+def _blake2b(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def _md5(data):
+    return hashlib.md5(data).digest()
+
+
+ALGORITHMS = {
+    "blake2b": _blake2b,
+    "md5": _md5,
+}
+
+if xxhash is not None:
+    ALGORITHMS["xxh3_64"] = xxhash.xxh3_64_digest
+    ALGORITHMS["xxh3_128"] = xxhash.xxh3_128_digest
+
+# Fingerprints of watch state stored before fingerprints were pluggable.
+LEGACY_ALGORITHM = "md5"
+
+DEFAULT_ALGORITHM = "xxh3_128" if xxhash is not None else "blake2b"
+
+
+def fingerprint(data, algorithm=DEFAULT_ALGORITHM):
+    """Return the binary fingerprint of a str or bytes-like object."""
+    if isinstance(data, str):
+        data = data.encode()
+    return ALGORITHMS[algorithm](data)
+
+
+class Fingerprinter:
+    """
+    Computes content fingerprints with one algorithm and compares them with
+    stored fingerprints, which may have been made with another one.
+
+    Fingerprints only decide whether content changed, so the default is the
+    fastest available algorithm: 128-bit xxh3 when the xxhash package is
+    installed and 128-bit BLAKE2b otherwise. Every fingerprint is stored
+    with the name of its algorithm, so changing the algorithm, or loading
+    MD5 hashes from older releases, never reports a change by itself.
+    """
+
+    def __init__(self, algorithm=None):
+        algorithm = algorithm or DEFAULT_ALGORITHM
+        if algorithm not in ALGORITHMS:
+            raise ValueError(
+                f"Unknown fingerprint algorithm {algorithm!r}, "
+                f"expected one of {', '.join(ALGORITHMS)}")
+        self.algorithm = algorithm
+
+    def digest(self, data):
+        """Return the fingerprint of data with this fingerprinter's algorithm."""
+        return fingerprint(data, self.algorithm)
+
+    def matches(self, data, stored, stored_algorithm=None):
+        """
+        Whether data has the stored fingerprint, recomputed with the
+        algorithm the stored fingerprint was made with.
+
+        A fingerprint made with an algorithm that is not available here,
+        such as xxh3 on a machine without xxhash, cannot be checked. It is
+        taken as a match, so the caller re-baselines the watch with the
+        current algorithm instead of alerting.
+        """
+        if not stored:
+            return False
+        algorithm = stored_algorithm or self.algorithm
+        if algorithm not in ALGORITHMS:
+            logger.warning(
+                "Fingerprint algorithm %s is not available, re-baselining "
+                "with %s.", algorithm, self.algorithm)
+            return True
+        return fingerprint(data, algorithm) == stored
+
+
+def migrate_legacy_hash(watch, legacy_hash):
+    """Adopt the hex MD5 hash an older release stored for a watch."""
+    if watch.fingerprint is None and legacy_hash:
+        watch.fingerprint = bytes.fromhex(legacy_hash)
+        watch.fingerprint_algorithm = LEGACY_ALGORITHM
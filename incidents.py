@@ -0,0 +1,80 @@
+"""
+incidents.py
+"""
+import time
+
+# fetch: network errors, timeouts and HTTP errors. missing: the page was
+# fetched but the watched element was not in it.
+INCIDENT_KINDS = ("fetch", "missing")
+
+OPENED = "opened"
+ONGOING = "ongoing"
+
+
+class IncidentTracker:
+    """
+    Tracks runs of failed checks per watch and kind, and decides which
+    failures are worth a notification.
+
+    An incident opens on the first failure of its kind and is alerted once
+    it reaches the kind's threshold of consecutive failures. While it lasts,
+    further alerts are suppressed, except for one summary per suppression
+    window. A successful check closes it. Incidents live on
+    watch.incidents as plain dicts, so the state store persists them.
+    """
+
+    def __init__(self, windows, thresholds):
+        for kind in INCIDENT_KINDS:
+            if kind not in windows or kind not in thresholds:
+                raise ValueError(f"Missing settings for incident kind {kind!r}")
+        self.windows = windows
+        self.thresholds = thresholds
+        self.suppressed = 0
+
+    def fail(self, watch, kind, now=None):
+        """
+        Record a failed check. Returns OPENED when the incident should be
+        alerted for the first time, ONGOING when a summary is due, and None
+        when the failure is below the threshold or suppressed.
+        """
+        now = time.time() if now is None else now
+        if watch.incidents is None:
+            watch.incidents = {}
+        incident = watch.incidents.setdefault(kind, {
+            "since": now,
+            "failures": 0,
+            "alerted_at": None,
+            "suppressed": 0,
+        })
+        incident["failures"] += 1
+        if incident["failures"] < self.thresholds[kind]:
+            return None
+        if incident["alerted_at"] is None:
+            incident["alerted_at"] = now
+            return OPENED
+        if now - incident["alerted_at"] >= self.windows[kind]:
+            incident["alerted_at"] = now
+            return ONGOING
+        incident["suppressed"] += 1
+        self.suppressed += 1
+        return None
+
+    @staticmethod
+    def resolve(watch, kind):
+        """
+        Close the incident of a kind. Returns it when it had been alerted,
+        so the recovery can be reported, and None otherwise.
+        """
+        if not watch.incidents or kind not in watch.incidents:
+            return None
+        incident = watch.incidents.pop(kind)
+        return incident if incident["alerted_at"] is not None else None
+
+    @staticmethod
+    def open_incidents(watches):
+        """Return the number of open incidents per kind."""
+        counts = dict.fromkeys(INCIDENT_KINDS, 0)
+        for watch in watches:
+            for kind in watch.incidents or ():
+                counts[kind] += 1
+        return counts
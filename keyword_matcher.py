@@ -0,0 +1,136 @@
+"""
+keyword_matcher.py
+"""
+from collections import deque
+from functools import lru_cache
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+
+class KeywordMatch:
+    """
+    A keyword occurrence, with offsets into the casefolded text.
+    """
+
+    __slots__ = ("keyword", "start", "end")
+
+    def __init__(self, keyword, start, end):
+        self.keyword = keyword
+        self.start = start
+        self.end = end
+
+    def __eq__(self, other):
+        return (isinstance(other, KeywordMatch) and
+                (self.keyword, self.start, self.end) ==
+                (other.keyword, other.start, other.end))
+
+    def __hash__(self):
+        return hash((self.keyword, self.start, self.end))
+
+    def __repr__(self):
+        return f"KeywordMatch({self.keyword!r}, {self.start}, {self.end})"
+
+
+class KeywordMatcher:
+    """
+    Aho-Corasick automaton that finds every keyword in a single pass.
+
+    Keywords and text are casefolded, so matching is case-insensitive and
+    offsets refer to the casefolded text. The pyahocorasick C extension is
+    used when it is installed; otherwise the automaton is built in Python.
+    """
+
+    def __init__(self, keywords):
+        self.keywords = tuple(dict.fromkeys(
+            keyword.casefold() for keyword in keywords if keyword))
+        if ahocorasick is not None:
+            self._automaton = ahocorasick.Automaton()
+            for keyword in self.keywords:
+                self._automaton.add_word(keyword, keyword)
+            if self.keywords:
+                self._automaton.make_automaton()
+        else:
+            self._automaton = None
+            self._build()
+
+    def _build(self):
+        """Build the goto, failure and output tables of the automaton."""
+        goto = [{}]
+        outputs: list[tuple[str, ...]] = [()]
+        for keyword in self.keywords:
+            state = 0
+            for char in keyword:
+                next_state = goto[state].get(char)
+                if next_state is None:
+                    next_state = len(goto)
+                    goto[state][char] = next_state
+                    goto.append({})
+                    outputs.append(())
+                state = next_state
+            outputs[state] += (keyword,)
+
+        fail = [0] * len(goto)
+        queue = deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in goto[state].items():
+                queue.append(next_state)
+                fallback = fail[state]
+                while fallback and char not in goto[fallback]:
+                    fallback = fail[fallback]
+                fail[next_state] = goto[fallback].get(char, 0)
+                outputs[next_state] += outputs[fail[next_state]]
+
+        self._goto = goto
+        self._fail = fail
+        self._outputs = outputs
+        self._alphabet = frozenset(goto[0]).union(*goto[1:])
+
+    def find_all(self, text):
+        """Return every keyword occurrence in text, in order of their end."""
+        if not self.keywords:
+            return []
+        text = text.casefold()
+        if self._automaton is not None:
+            return [
+                KeywordMatch(keyword, end + 1 - len(keyword), end + 1)
+                for end, keyword in self._automaton.iter(text)
+            ]
+
+        goto = self._goto
+        fail = self._fail
+        outputs = self._outputs
+        alphabet = self._alphabet
+        matches = []
+        state = 0
+        for index, char in enumerate(text):
+            if char not in alphabet:
+                state = 0
+                continue
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for keyword in outputs[state]:
+                matches.append(
+                    KeywordMatch(keyword, index + 1 - len(keyword), index + 1))
+        return matches
+
+    def matches(self, text):
+        """Return the offsets of every keyword found in text, by keyword."""
+        found = {}
+        for match in self.find_all(text):
+            found.setdefault(match.keyword, []).append((match.start, match.end))
+        return found
+
+
+@lru_cache(maxsize=256)
+def _compile(keywords):
+    return KeywordMatcher(keywords)
+
+
+def compile_keywords(keywords):
+    """Return the matcher for the keyword set, shared by equal keyword sets."""
+    return _compile(tuple(keywords))
@@ -2,11 +2,29 @@
 Logger.py
 """
 
+import asyncio
+import atexit
+import hashlib
+import itertools
+import json
 import logging
+import logging.handlers
+import math
 import os
+import queue
+import shutil
 import sys
 import time
 
+LOG_FORMATS = ("text", "json")
+
+# Fields passed with extra= that the JSON formatter writes out.
+STRUCTURED_FIELDS = ("watch_id", "url", "phase", "duration_ms", "repeated")
+
+PREVIEW_LENGTH = 200
+
+REPEAT_WINDOW = 300
+
 
 class Logger:
     """
@@ -34,12 +52,106 @@ class Logger:
         logging.INFO: LogColors.INFO,
     }
 
+    _listener = None
+    _handler = None
+
+    class ColorFormatter(logging.Formatter):
+        """
+        Formatter that colors the level name of each record.
+        """
+
+        def format(self, record):
+            color = Logger.LEVEL_COLORS.get(record.levelno)
+            if color:
+                record = logging.makeLogRecord(record.__dict__)
+                record.levelname = (f"{color}{record.levelname}"
+                                    f"{Logger.LogColors.ENDC}")
+            return super().format(record)
+
+    class JsonFormatter(logging.Formatter):
+        """
+        Formatter that writes each record as one JSON object per line.
+        """
+
+        def format(self, record):
+            entry = {
+                "time": (f"{self.formatTime(record, '%Y-%m-%dT%H:%M:%S')}"
+                         f".{int(record.msecs):03d}"),
+                "level": record.levelname,
+                "module": record.module,
+                "function": record.funcName,
+                "message": record.getMessage(),
+            }
+            for field in STRUCTURED_FIELDS:
+                value = getattr(record, field, None)
+                if value is not None:
+                    entry[field] = value
+            return json.dumps(entry, ensure_ascii=False, default=str)
+
+    class RepeatFilter(logging.Filter):
+        """
+        Drops warnings and errors of a watch that repeat an identical
+        message within window seconds. The first message after the window
+        carries the number of repeats that were dropped.
+        """
+
+        def __init__(self, window=REPEAT_WINDOW, max_keys=10000):
+            super().__init__()
+            self.window = window
+            self.max_keys = max_keys
+            self._seen = {}
+
+        def filter(self, record):
+            watch_id = getattr(record, "watch_id", None)
+            if watch_id is None or record.levelno < logging.WARNING:
+                return True
+            key = (watch_id, record.levelno, record.getMessage())
+            now = time.monotonic()
+            seen = self._seen.get(key)
+            if seen is not None and now - seen[0] < self.window:
+                seen[1] += 1
+                return False
+            if seen is not None and seen[1]:
+                record.repeated = seen[1]
+                record.msg = (f"{record.getMessage()} (repeated {seen[1]} "
+                              f"times in the last {self.window}s)")
+                record.args = None
+            if len(self._seen) >= self.max_keys:
+                self._seen = {
+                    old_key: value for old_key, value in self._seen.items()
+                    if now - value[0] < self.window
+                }
+            self._seen[key] = [now, 0]
+            return True
+
+    @staticmethod
+    def preview(content, length=PREVIEW_LENGTH):
+        """
+        Shorten content for a log message. Long content is cut to length
+        characters and identified by its size and a short digest.
+        """
+        if content is None or len(content) <= length:
+            return content
+        digest = hashlib.sha1(content.encode()).hexdigest()[:12]
+        return f"{content[:length]}... ({len(content)} chars, sha1 {digest})"
+
     @classmethod
-    def setup_logger(cls):
+    def _formatter(cls, stream, log_format="text"):
         """
-        Set up the logger with custom formatting and colors.
+        Build the record formatter: JSON lines, or text with colors and
+        delimiters sized to the terminal when stream is a TTY and plain
+        single lines otherwise.
         """
-        terminal_width = os.get_terminal_size().columns
+        if log_format == "json":
+            return cls.JsonFormatter()
+        datefmt = "%Y-%m-%d %H:%M:%S"
+        if not stream.isatty():
+            return logging.Formatter(
+                "%(asctime)s %(levelname)s [%(module)s -> %(funcName)s] "
+                "%(message)s",
+                datefmt=datefmt)
+
+        terminal_width = shutil.get_terminal_size().columns
 
         delimiter_start = f"{cls.LogColors.DELIMITER}"
         delimiter_end = f"{cls.LogColors.ENDC}"
@@ -61,47 +173,76 @@ class Logger:
                       f"{level_info}\n"
                       f"%(message)s\n"
                       f"{end_delimiter}\n")
+        return cls.ColorFormatter(log_format, datefmt=datefmt)
 
-        logging.basicConfig(level=logging.INFO,
-                            format=log_format,
-                            datefmt="%Y-%m-%d %H:%M:%S")
+    @classmethod
+    def setup_logger(cls, log_format=None):
+        """
+        Set up the root logger once and return it.
 
-        for level, color in cls.LEVEL_COLORS.items():
-            logging.addLevelName(
-                level,
-                f"{color}{logging.getLevelName(level)}{cls.LogColors.ENDC}")
+        Records are put on a queue by the calling thread and formatted and
+        written to stderr by a background listener thread, so logging does
+        not block the event loop. Later calls return the configured logger;
+        a root logger that already has handlers is left as it is.
 
-        return logging.getLogger()
+        log_format is "text" or "json", defaulting to the LOG_FORMAT
+        environment variable. Repeated warnings and errors of a watch are
+        rate limited in both formats.
+        """
+        root = logging.getLogger()
+        if cls._listener is not None or root.handlers:
+            return root
+
+        log_format = (log_format or os.getenv("LOG_FORMAT") or "text").lower()
+        if log_format not in LOG_FORMATS:
+            raise ValueError(
+                f"Unknown log format {log_format!r}, "
+                f"expected one of {', '.join(LOG_FORMATS)}")
+        stream_handler = logging.StreamHandler(sys.stderr)
+        stream_handler.setFormatter(cls._formatter(sys.stderr, log_format))
+        log_queue = queue.SimpleQueue()
+        cls._listener = logging.handlers.QueueListener(
+            log_queue, stream_handler, respect_handler_level=True)
+        cls._listener.start()
+        atexit.register(cls.shutdown)
+
+        cls._handler = logging.handlers.QueueHandler(log_queue)
+        cls._handler.addFilter(cls.RepeatFilter())
+        root.addHandler(cls._handler)
+        root.setLevel(logging.INFO)
+        return root
 
     @classmethod
-    def _moon_phase_spinner(cls, remaining_time):
-        """
-        Display a moon phase spinner for the current second.
-        """
-        moon_phases = ["🌑", "🌒", "🌓", "🌔", "🌕", "🌖", "🌗", "🌘"]
-        for phase in moon_phases:
-            sys.stdout.write(
-                f"\r{phase} Next check in {remaining_time} seconds...")
-            sys.stdout.flush()
-            time.sleep(1 / len(moon_phases))
+    def shutdown(cls):
+        """Write out queued records and stop the listener thread."""
+        if cls._handler is not None:
+            logging.getLogger().removeHandler(cls._handler)
+        if cls._listener is not None:
+            cls._listener.stop()
+            cls._listener = None
+            cls._handler = None
 
     @classmethod
-    def display_timer(cls, duration):
+    async def display_countdown(cls, next_due_at, refresh_interval=1.0):
         """
-        Display a countdown timer with a moon phase spinner for the given duration.
+        Redraw a countdown to the next check every refresh_interval seconds
+        until cancelled. next_due_at returns a time.monotonic() deadline, or
+        None when nothing is scheduled.
         """
+        moon_phases = ["🌑", "🌒", "🌓", "🌔", "🌕", "🌖", "🌗", "🌘"]
         sys.stdout.write("\033[?25l")  # Hide cursor
-        sys.stdout.flush()
-
-        remaining_time = duration
-        while remaining_time > 0:
-            cls._moon_phase_spinner(remaining_time)
-            remaining_time -= 1
-
-        sys.stdout.write("\r" + " " * 30 + "\r")  # Clear line
-        sys.stdout.write("\rChecking started...")
-        sys.stdout.flush()
-        time.sleep(1)
-        print()
-        sys.stdout.write("\033[?25h")  # Show cursor
-        sys.stdout.flush()
+        try:
+            for phase in itertools.cycle(moon_phases):
+                due_at = next_due_at()
+                if due_at is None:
+                    line = f"{phase} Waiting for checks..."
+                else:
+                    remaining_time = math.ceil(max(0.0, due_at - time.monotonic()))
+                    line = f"{phase} Next check in {remaining_time} seconds..."
+                sys.stdout.write(f"\r{line:<40}")
+                sys.stdout.flush()
+                await asyncio.sleep(refresh_interval)
+        finally:
+            sys.stdout.write("\r" + " " * 40 + "\r")  # Clear line
+            sys.stdout.write("\033[?25h")  # Show cursor
+            sys.stdout.flush()
@@ -80,7 +80,7 @@ async def main():
     try:
         interval = await get_interval()
         website_monitor = WebsiteMonitor(Config(interval=interval))
-        website_monitor.run()
+        await website_monitor.run()
     except Exception as e:
         logger.error(f"An error occurred: {e}")
         logger.error("The website monitor could not be started.")
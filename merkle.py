@@ -0,0 +1,265 @@
+"""
+merkle.py
+"""
+import difflib
+import hashlib
+import struct
+from html.parser import HTMLParser
+
+from extractor import VOID_ELEMENTS
+
+MAX_REPORTED_BLOCKS = 20
+
+_NODE_HEADER = struct.Struct(">8sIB")
+
+
+def _digest(data):
+    return hashlib.blake2b(data, digest_size=8).digest()
+
+
+class MerkleNode:
+    """
+    An element in a section's Merkle tree.
+
+    The hash of an element covers its start tag, its text and the hashes of
+    its child elements in document order, so two subtrees with equal hashes
+    are equal and a change anywhere changes the hash of every ancestor. The
+    label names the element among its siblings, like tr:nth-of-type(3) or
+    div#main. start and end are offsets into the markup the tree was built
+    from; they are not stored.
+    """
+
+    __slots__ = ("label", "hash", "children", "start", "end")
+
+    def __init__(self, label, node_hash=b"", children=None, start=None,
+                 end=None):
+        self.label = label
+        self.hash = node_hash
+        self.children = children if children is not None else []
+        self.start = start
+        self.end = end
+
+    @property
+    def tag(self):
+        """Return the tag name of the element without its sibling qualifier."""
+        return self.label.partition("#")[0].partition(":")[0]
+
+    def __repr__(self):
+        return f"MerkleNode({self.label!r}, {self.hash.hex()})"
+
+
+def _label(name, counts):
+    """
+    Label an element named tag or tag#id, counting same-tag siblings in
+    counts so elements without an id get their nth-of-type position.
+    """
+    if "#" in name:
+        return name
+    counts[name] = counts.get(name, 0) + 1
+    return f"{name}:nth-of-type({counts[name]})"
+
+
+class _TreeBuilder(HTMLParser):
+    """
+    Tokenizer that builds the Merkle tree of a section's markup.
+    """
+
+    def __init__(self, markup):
+        super().__init__(convert_charrefs=True)
+        self.markup = markup
+        self.root = MerkleNode("#root", start=0)
+        # Open elements with their hash inputs and sibling tag counts.
+        self._stack = [(self.root, [b"#root"], {})]
+        self._line_starts = [0]
+        index = markup.find("\n")
+        while index != -1:
+            self._line_starts.append(index + 1)
+            index = markup.find("\n", index + 1)
+
+    def _offset(self):
+        lineno, column = self.getpos()
+        return self._line_starts[lineno - 1] + column
+
+    def _open(self, tag, attrs):
+        parent, parent_parts, counts = self._stack[-1]
+        element_id = dict(attrs).get("id")
+        name = f"{tag}#{element_id}" if element_id else tag
+        node = MerkleNode(_label(name, counts), start=self._offset())
+        parent.children.append(node)
+        return node, [(self.get_starttag_text() or "").encode()]
+
+    def _close(self, node, parts, end):
+        node.hash = _digest(b"\0".join(parts))
+        node.end = end
+        self._stack[-1][1].append(node.hash)
+
+    def handle_starttag(self, tag, attrs):
+        node, parts = self._open(tag, attrs)
+        if tag in VOID_ELEMENTS:
+            self._close(node, parts,
+                        self._offset() + len(self.get_starttag_text() or ""))
+        else:
+            self._stack.append((node, parts, {}))
+
+    def handle_startendtag(self, tag, attrs):
+        node, parts = self._open(tag, attrs)
+        self._close(node, parts,
+                    self._offset() + len(self.get_starttag_text() or ""))
+
+    def handle_endtag(self, tag):
+        if not any(node.tag == tag for node, _, _ in self._stack[1:]):
+            return
+        end = self.markup.find(">", self._offset()) + 1
+        while True:
+            node, parts, _ = self._stack.pop()
+            self._close(node, parts, end)
+            if node.tag == tag:
+                return
+
+    def handle_data(self, data):
+        if data.strip():
+            self._stack[-1][1].append(data.encode())
+
+    def build(self):
+        """Return the root of the tree."""
+        self.feed(self.markup)
+        self.close()
+        while len(self._stack) > 1:
+            node, parts, _ = self._stack.pop()
+            self._close(node, parts, len(self.markup))
+        self.root.hash = _digest(b"\0".join(self._stack[0][1]))
+        self.root.end = len(self.markup)
+        return self.root
+
+
+def build_tree(markup):
+    """Return the Merkle tree of the markup, under a #root node."""
+    return _TreeBuilder(markup).build()
+
+
+def serialize(root):
+    """
+    Encode a tree in pre-order as compact bytes for the state store. Only
+    tag names and ids are written; positions are recounted on load.
+    """
+    out = []
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        name = node.label.partition(":")[0].encode()[:255]
+        out.append(_NODE_HEADER.pack(node.hash, len(node.children), len(name)))
+        out.append(name)
+        stack.extend(reversed(node.children))
+    return b"".join(out)
+
+
+def deserialize(data):
+    """Decode a tree written by serialize()."""
+    view = memoryview(data)
+    offset = 0
+
+    def read(counts):
+        nonlocal offset
+        node_hash, count, length = _NODE_HEADER.unpack_from(view, offset)
+        offset += _NODE_HEADER.size
+        name = str(view[offset:offset + length], "utf-8")
+        offset += length
+        return MerkleNode(_label(name, counts), node_hash), count
+
+    root, count = read({"#root": 0})
+    root.label = "#root"
+    stack = [(root, count, {})]
+    while stack:
+        parent, remaining, counts = stack[-1]
+        if not remaining:
+            stack.pop()
+            continue
+        stack[-1] = (parent, remaining - 1, counts)
+        node, count = read(counts)
+        parent.children.append(node)
+        stack.append((node, count, {}))
+    return root
+
+
+class ChangedBlock:
+    """
+    An element that differs between two trees: changed, added or removed.
+    node is the new element, or the old one when it was removed. path is
+    the label path of node and old_path that of the old element, or None
+    when it was added.
+    """
+
+    __slots__ = ("path", "kind", "node", "old_path")
+
+    def __init__(self, path, kind, node, old_path=None):
+        self.path = path
+        self.kind = kind
+        self.node = node
+        self.old_path = old_path
+
+    def __repr__(self):
+        return f"ChangedBlock({self.path!r}, {self.kind!r})"
+
+
+def changed_blocks(old, new):
+    """
+    Return the smallest blocks that differ between two trees.
+
+    Subtrees with equal hashes are skipped without being visited, so the
+    work grows with the number of changed elements and their siblings
+    rather than with the size of the section. An element whose child
+    elements are all unchanged changed its own tag or text and is reported
+    as a whole. Children are aligned by their hashes; a changed child
+    between the same unchanged neighbours is compared recursively with the
+    old child of the same tag, and the rest are reported as added or
+    removed.
+    """
+    blocks = []
+    stack: list[tuple[MerkleNode, MerkleNode, tuple[str, ...],
+                      tuple[str, ...]]] = [(old, new, (), ())]
+    while stack:
+        old_node, new_node, path, old_path = stack.pop()
+        if old_node.hash == new_node.hash:
+            continue
+        old_children, new_children = old_node.children, new_node.children
+        matcher = difflib.SequenceMatcher(
+            None, [child.hash for child in old_children],
+            [child.hash for child in new_children], autojunk=False)
+        opcodes = [op for op in matcher.get_opcodes() if op[0] != "equal"]
+        if path and not opcodes:
+            blocks.append(ChangedBlock(path, "changed", new_node, old_path))
+            continue
+        pairs = []
+        for _, i1, i2, j1, j2 in opcodes:
+            removed = old_children[i1:i2]
+            for child in new_children[j1:j2]:
+                match = next((c for c in removed if c.tag == child.tag), None)
+                if match is None:
+                    blocks.append(ChangedBlock(path + (child.label,), "added",
+                                               child))
+                else:
+                    removed.remove(match)
+                    pairs.append((match, child))
+            for child in removed:
+                child_path = old_path + (child.label,)
+                blocks.append(ChangedBlock(child_path, "removed", child,
+                                           child_path))
+        for old_child, new_child in reversed(pairs):
+            stack.append((old_child, new_child, path + (new_child.label,),
+                          old_path + (old_child.label,)))
+    return blocks
+
+
+def find_node(root, path):
+    """Return the element at the given label path below root, or None."""
+    node = root
+    for label in path:
+        node = next((c for c in node.children if c.label == label), None)
+        if node is None:
+            return None
+    return node
+
+
+def format_path(path):
+    """Return a block path as a CSS-like selector."""
+    return " > ".join(path)
@@ -0,0 +1,255 @@
+"""
+normalizer.py
+"""
+import re
+from collections import Counter
+
+from extractor import VOID_ELEMENTS
+
+# Opt-in scrubbers for noise that many pages carry.
+CACHE_BUSTING_SCRUBBER = (
+    r"((?:&amp;|[?&])(?:v|ver|version|_|t|ts|cb|cachebust|timestamp)=)"
+    r"[^&\"'\s>]*",
+    r"\1",
+    "cache-busting",
+)
+TIMESTAMP_SCRUBBER = (
+    r"\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}(?::\d{2}(?:\.\d+)?)?"
+    r"(?:Z|[+-]\d{2}:?\d{2})?",
+    "",
+    "timestamps",
+)
+COMMON_SCRUBBERS = (CACHE_BUSTING_SCRUBBER, TIMESTAMP_SCRUBBER)
+
+COMMON_DROPPED_ATTRIBUTES = ("nonce", "data-csrf", "data-token", "csrf-token")
+
+_TAG = re.compile(r"<(/?)([a-zA-Z][\w:-]*)([^>]*)>")
+
+_ATTRIBUTE = re.compile(
+    r"""([^\s=/>"']+)(?:\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>"']+)))?""")
+
+_SELECTOR = re.compile(
+    r"^([a-zA-Z][\w-]*)?((?:[#.][\w-]+)*)"
+    r"(?:\[([\w:-]+)(?:=[\"']?([^\"'\]]*)[\"']?)?\])?$")
+
+_SCRIPTS = re.compile(r"<script\b[^>]*>.*?</script\s*>", re.I | re.S)
+
+_STYLES = re.compile(r"<style\b[^>]*>.*?</style\s*>", re.I | re.S)
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def _attributes(text):
+    """Parse the attributes of a start tag into a dict."""
+    return {
+        match.group(1).lower(): next(
+            (value for value in match.group(2, 3, 4) if value is not None), "")
+        for match in _ATTRIBUTE.finditer(text)
+    }
+
+
+class _Selector:
+    """
+    A simple CSS selector: tag, #id, .class and one [attr] or [attr=value]
+    in any combination, like div.ad or input[name=csrf].
+    """
+
+    def __init__(self, selector):
+        match = _SELECTOR.match(selector.strip())
+        if match is None or not any(match.groups()):
+            raise ValueError(f"Unsupported ignore selector {selector!r}")
+        tag, qualifiers, self.attribute, self.value = match.groups()
+        self.text = selector
+        self.tag = tag.lower() if tag else None
+        self.element_id = None
+        self.classes = set()
+        for qualifier in re.findall(r"[#.][\w-]+", qualifiers):
+            if qualifier[0] == "#":
+                self.element_id = qualifier[1:]
+            else:
+                self.classes.add(qualifier[1:])
+        self.needs_attributes = bool(
+            self.element_id or self.classes or self.attribute)
+        # Prefix of the start tags this selector could match.
+        token = self.element_id or next(iter(self.classes), self.attribute)
+        self.candidate = (re.escape(tag) if tag else r"[a-zA-Z][\w:-]*")
+        self.candidate += r"(?=[\s/>])"
+        if token:
+            self.candidate += rf"(?=[^>]*{re.escape(token)})"
+
+    def matches(self, tag, attributes):
+        if self.tag and tag != self.tag:
+            return False
+        if self.element_id and attributes.get("id") != self.element_id:
+            return False
+        if self.classes and not self.classes <= set(
+                attributes.get("class", "").split()):
+            return False
+        if self.attribute:
+            value = attributes.get(self.attribute.lower())
+            if value is None or (self.value is not None
+                                 and value != self.value):
+                return False
+        return True
+
+
+class Normalizer:
+    """
+    Pipeline that removes volatile noise from a section before it is
+    fingerprinted, so rotating tokens or timestamps do not count as changes.
+
+    The steps run in this order: strip <script> and <style> elements,
+    remove elements matching the ignore selectors and drop the listed
+    attributes in one pass over the tags, apply the regex scrubbers, given
+    as (pattern, replacement) or (pattern, replacement, name), and collapse
+    runs of whitespace. Every pattern is compiled once, when the normalizer
+    is created.
+
+    hits counts how often each rule changed something, by rule name.
+    """
+
+    def __init__(self, drop_attributes=(), scrubbers=(), strip_scripts=False,
+                 strip_styles=False, ignore_selectors=(),
+                 collapse_whitespace=False):
+        self.drop_attributes = frozenset(
+            name.lower() for name in drop_attributes)
+        self.scrubbers = []
+        for pattern, replacement, *name in scrubbers:
+            self.scrubbers.append((f"scrub:{name[0] if name else pattern}",
+                                   re.compile(pattern), replacement))
+        self.strip_scripts = strip_scripts
+        self.strip_styles = strip_styles
+        self.ignore_selectors = [
+            _Selector(selector) for selector in ignore_selectors]
+        self.collapse_whitespace = collapse_whitespace
+        self._dropped_attribute = self._tag_with_dropped = None
+        if self.drop_attributes:
+            names = "|".join(re.escape(name) for name in
+                             sorted(self.drop_attributes))
+            value = (r"""(?:\s*=\s*(?:"[^"]*"|'[^']*'|[^\s>"']+))?"""
+                     r"""(?=[\s/>])""")
+            self._dropped_attribute = re.compile(rf"\s({names}){value}", re.I)
+            # Start tags carrying one of the attributes; only these are
+            # handed to Python.
+            self._tag_with_dropped = re.compile(
+                rf"<[a-zA-Z][^>]*?\s(?:{names}){value}[^>]*>",
+                re.I)
+        # Start tags that may match an ignore selector, checked in full
+        # only when the regex engine finds one.
+        self._ignore_candidate = None
+        if self.ignore_selectors:
+            self._ignore_candidate = re.compile(
+                "<(?:" + "|".join(selector.candidate
+                                  for selector in self.ignore_selectors) + ")",
+                re.I)
+        self._same_tag = {}
+        # Every rule starts at zero, so rules that never fire show up too.
+        self.hits = Counter(dict.fromkeys(self.rules, 0))
+
+    @property
+    def rules(self):
+        """Return the names of the configured rules, in pipeline order."""
+        names = []
+        if self.strip_scripts:
+            names.append("strip-scripts")
+        if self.strip_styles:
+            names.append("strip-styles")
+        names.extend(f"ignore:{selector.text}"
+                     for selector in self.ignore_selectors)
+        names.extend(f"drop-attribute:{name}"
+                     for name in sorted(self.drop_attributes))
+        names.extend(name for name, _, _ in self.scrubbers)
+        if self.collapse_whitespace:
+            names.append("collapse-whitespace")
+        return names
+
+    def __bool__(self):
+        return bool(self.rules)
+
+    def normalize(self, markup):
+        """Return the markup with every rule applied."""
+        hits = self.hits
+        if self.strip_scripts:
+            markup, count = _SCRIPTS.subn("", markup)
+            hits["strip-scripts"] += count
+        if self.strip_styles:
+            markup, count = _STYLES.subn("", markup)
+            hits["strip-styles"] += count
+        if self.ignore_selectors:
+            markup = self._remove_ignored(markup)
+        if self._tag_with_dropped is not None:
+            markup = self._tag_with_dropped.sub(self._drop_attributes, markup)
+        for name, pattern, replacement in self.scrubbers:
+            markup, count = pattern.subn(replacement, markup)
+            hits[name] += count
+        if self.collapse_whitespace:
+            markup, count = _WHITESPACE.subn(" ", markup)
+            hits["collapse-whitespace"] += count
+        return markup
+
+    __call__ = normalize
+
+    def _drop_attributes(self, match):
+        """Drop the listed attributes from one start tag."""
+        hits = self.hits
+        assert self._dropped_attribute is not None
+
+        def drop(attribute):
+            hits[f"drop-attribute:{attribute.group(1).lower()}"] += 1
+            return ""
+
+        return self._dropped_attribute.sub(drop, match.group())
+
+    def _remove_ignored(self, markup):
+        """Remove the elements matching an ignore selector."""
+        out = []
+        position = 0
+        assert self._ignore_candidate is not None
+        search = self._ignore_candidate.search
+        match = search(markup)
+        while match is not None:
+            tag_match = _TAG.match(markup, match.start())
+            if tag_match is None:
+                match = search(markup, match.end())
+                continue
+            _, tag, rest = tag_match.groups()
+            tag = tag.lower()
+            selector = self._ignored_by(tag, rest)
+            if selector is None:
+                match = search(markup, tag_match.end())
+                continue
+            self.hits[f"ignore:{selector.text}"] += 1
+            out.append(markup[position:tag_match.start()])
+            position = self._element_end(markup, tag, tag_match)
+            match = search(markup, position)
+        out.append(markup[position:])
+        return "".join(out)
+
+    def _element_end(self, markup, tag, start_tag):
+        """Return the offset after the element opened by start_tag."""
+        if tag in VOID_ELEMENTS or start_tag.group(3).endswith("/"):
+            return start_tag.end()
+        pattern = self._same_tag.get(tag)
+        if pattern is None:
+            pattern = self._same_tag[tag] = re.compile(
+                rf"<(/?){re.escape(tag)}(?=[\s/>])[^>]*>", re.I)
+        depth = 1
+        for match in pattern.finditer(markup, start_tag.end()):
+            if match.group(1):
+                depth -= 1
+                if depth == 0:
+                    return match.end()
+            elif not match.group().endswith("/>"):
+                depth += 1
+        # Unclosed: the element runs to the end of the section.
+        return len(markup)
+
+    def _ignored_by(self, tag, rest):
+        """Return the first ignore selector matching a start tag, if any."""
+        attributes = None
+        for selector in self.ignore_selectors:
+            if selector.needs_attributes and attributes is None:
+                attributes = _attributes(rest)
+            if selector.matches(tag, attributes):
+                return selector
+        return None
@@ -0,0 +1,288 @@
+"""
+outbox.py
+"""
+import asyncio
+import contextlib
+import random
+import time
+import uuid
+from collections import deque
+
+from channels import DeliveryRefused
+from logger import Logger
+
+logger = Logger.setup_logger()
+
+OVERFLOW_POLICIES = ("drop-newest", "drop-oldest", "spill")
+
+RETENTION = 7 * 24 * 3600
+
+
+class OutboxMetrics:
+    """
+    Backpressure counters of the outbox, over all of its channels. sent,
+    retried and failed count deliveries on single channels.
+    """
+
+    def __init__(self):
+        self.enqueued = 0
+        self.duplicates = 0
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.spill_depth = 0
+        self.depth = 0
+        self.high_water = 0
+        self.total_wait = 0.0
+
+    @property
+    def average_wait(self):
+        """Average seconds a delivery waited before being sent."""
+        handled = self.sent + self.retried + self.failed
+        return self.total_wait / handled if handled else 0.0
+
+    def __str__(self):
+        return (
+            f"depth={self.depth} high_water={self.high_water} "
+            f"enqueued={self.enqueued} duplicates={self.duplicates} "
+            f"sent={self.sent} retried={self.retried} failed={self.failed} "
+            f"dropped={self.dropped} spilled={self.spilled} "
+            f"spill_depth={self.spill_depth} "
+            f"avg_wait={self.average_wait:.2f}s"
+        )
+
+
+class _ChannelQueue:
+    """
+    The in-memory queue of one channel and the state of its workers.
+    """
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.queue = deque()
+        self.in_flight = 0
+        self.ready = asyncio.Event()
+
+
+class NotificationOutbox:
+    """
+    Durable queue of notifications drained by background sender workers.
+
+    submit() only writes the notification to the state store, so it can
+    share a transaction with the state change that caused it and never
+    waits for the mail server. Workers claim due deliveries from the store
+    into bounded in-memory queues, send them, and retry failures with
+    exponential backoff until max_attempts is reached.
+
+    A notification goes to the channels named when it was submitted, or to
+    every channel, as one delivery per channel. Each channel has its own
+    queue, workers, retries and timeout, so a slow or failing webhook
+    cannot hold up the email, and a retry only goes to the channel that
+    failed. A delivery that was refused in part, such as an email some
+    recipients refused, is failed without a retry, since it would repeat
+    the message for the others. The notification is finished once every
+    delivery is.
+
+    Every notification has a message id. Enqueuing the same id twice is a
+    no-op, and the id is passed on to the channels so a send that is
+    repeated after a crash carries the same Message-ID.
+
+    When the in-memory queue of a channel is full the overflow policy
+    decides what happens on that channel: drop-newest discards the new
+    notification, drop-oldest discards the longest waiting one, and spill
+    leaves it in the store until the queue has room.
+    """
+
+    def __init__(self, channels, config, store, maxsize=1000, workers=2,
+                 policy="spill", max_attempts=8, retry_base=5, retry_max=900):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(
+                f"Unknown overflow policy {policy!r}, "
+                f"expected one of {', '.join(OVERFLOW_POLICIES)}")
+        self.channels = {channel.name: channel for channel in channels}
+        if len(self.channels) != len(channels):
+            raise ValueError("Notification channel names must be unique")
+        self.config = config
+        self.store = store
+        self.maxsize = maxsize
+        self.workers = workers
+        self.policy = policy
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.metrics = OutboxMetrics()
+        self._queues = {
+            name: _ChannelQueue(channel)
+            for name, channel in self.channels.items()
+        }
+        self._tasks = []
+
+    def submit(self, subject, body, message_id=None, channels=None,
+               recipients=None, url=None, diff=None):
+        """
+        Store a notification for delivery on the named channels, or on all
+        of them, to the given recipients, or the configured ones, without
+        blocking. The url and diff are rendered apart from the body. Returns
+        False when it is a duplicate of an earlier message id or was dropped
+        on every channel.
+        """
+        message_id = message_id or uuid.uuid4().hex
+        names = [name for name in (self.channels if channels is None
+                                   else channels)
+                 if name in self.channels]
+        if not self.store.enqueue_notification(message_id, subject, body,
+                                               names, recipients, url, diff):
+            self.metrics.duplicates += 1
+            return False
+        self.metrics.enqueued += 1
+        admitted = [self._admit(self._queues[name], message_id, subject)
+                    for name in names]
+        return not names or any(admitted)
+
+    def _admit(self, channel_queue, message_id, subject):
+        """
+        Apply the overflow policy of a channel to a new delivery and wake
+        the channel's workers. Returns False when the delivery was dropped.
+        """
+        name = channel_queue.channel.name
+        if len(channel_queue.queue) >= self.maxsize:
+            if self.policy == "drop-newest":
+                self.store.mark_done(message_id, name, "dropped")
+                self.metrics.dropped += 1
+                logger.warning("Outbox full on %s, dropped notification: %s",
+                               name, subject)
+                return False
+            if self.policy == "drop-oldest":
+                dropped = channel_queue.queue.popleft()
+                self.store.mark_done(dropped.message_id, name, "dropped")
+                self.metrics.dropped += 1
+                logger.warning("Outbox full on %s, dropped notification: %s",
+                               name, dropped.subject)
+            else:
+                self.metrics.spilled += 1
+        channel_queue.ready.set()
+        return True
+
+    def _update_depth(self):
+        self.metrics.depth = sum(
+            len(channel_queue.queue) for channel_queue in self._queues.values())
+        self.metrics.high_water = max(self.metrics.high_water,
+                                      self.metrics.depth)
+
+    def _refill(self, channel_queue):
+        """Claim due deliveries of a channel while its queue has room."""
+        room = self.maxsize - len(channel_queue.queue)
+        if room > 0:
+            for notification in self.store.claim_due_deliveries(
+                    channel_queue.channel.name, room):
+                notification.queued_at = time.monotonic()
+                channel_queue.queue.append(notification)
+        self._update_depth()
+        self.metrics.spill_depth = self.store.pending_deliveries()
+
+    async def _wait_for_work(self, channel_queue):
+        """
+        Sleep until something is submitted to a channel or a retry on it
+        becomes due.
+        """
+        next_due_at = self.store.next_due_at(channel_queue.channel.name)
+        timeout = 30.0
+        if next_due_at is not None:
+            timeout = min(timeout, max(0.0, next_due_at - time.time()))
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(channel_queue.ready.wait(), timeout)
+
+    async def _worker(self, channel_queue):
+        channel = channel_queue.channel
+        while True:
+            if channel_queue.ready.is_set() or not channel_queue.queue:
+                channel_queue.ready.clear()
+                self._refill(channel_queue)
+            if not channel_queue.queue:
+                await self._wait_for_work(channel_queue)
+                continue
+            notification = channel_queue.queue.popleft()
+            self._update_depth()
+            self.metrics.total_wait += time.monotonic() - notification.queued_at
+            channel_queue.in_flight += 1
+            try:
+                await channel.deliver(notification, self.config)
+            except DeliveryRefused as error:
+                self.store.mark_done(notification.message_id, channel.name,
+                                     "failed", str(error))
+                self.metrics.failed += 1
+                logger.error("Notification %r (%s) on %s was %s",
+                             notification.subject, notification.message_id,
+                             channel.name, error)
+            except Exception as error:
+                self._retry_later(channel, notification, error)
+            else:
+                self.store.mark_sent(notification.message_id, channel.name)
+                self.metrics.sent += 1
+            finally:
+                channel_queue.in_flight -= 1
+
+    def _retry_later(self, channel, notification, error):
+        """Schedule another attempt on a channel with backoff, or give up."""
+        attempts = notification.attempts + 1
+        if attempts >= self.max_attempts:
+            self.store.mark_done(notification.message_id, channel.name,
+                                 "failed", str(error))
+            self.metrics.failed += 1
+            logger.error("Giving up on notification %r on %s after %d "
+                         "attempts: %s", notification.subject, channel.name,
+                         attempts, error)
+            return
+        delay = min(self.retry_max, self.retry_base * 2 ** (attempts - 1))
+        delay *= random.uniform(0.5, 1.0)
+        self.store.mark_retry(notification.message_id, channel.name, attempts,
+                              time.time() + delay, str(error))
+        self.metrics.retried += 1
+        logger.warning("Sending notification %r on %s failed, retrying in "
+                       "%.0fs: %s", notification.subject, channel.name, delay,
+                       error)
+
+    def _busy(self):
+        """Whether deliveries are queued, in flight or due in the store."""
+        for channel_queue in self._queues.values():
+            if channel_queue.queue or channel_queue.in_flight:
+                return True
+        next_due_at = self.store.next_due_at()
+        return next_due_at is not None and next_due_at <= time.time()
+
+    def start(self):
+        """Start the sender workers of every channel on the running loop."""
+        self.store.prune_notifications(time.time() - RETENTION)
+        self.store.prepare_deliveries(list(self.channels))
+        for channel_queue in self._queues.values():
+            channel_queue.ready = asyncio.Event()
+            channel_queue.ready.set()
+        self._tasks = [
+            asyncio.create_task(self._worker(channel_queue))
+            for channel_queue in self._queues.values()
+            for _ in range(self.workers)
+        ]
+
+    async def stop(self, timeout=30):
+        """
+        Give queued notifications up to timeout seconds, then stop. Anything
+        not yet sent stays pending in the store for the next start.
+        """
+        deadline = time.monotonic() + timeout
+        while self._busy() and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        for name, channel_queue in self._queues.items():
+            while channel_queue.queue:
+                self.store.release_notification(
+                    channel_queue.queue.popleft().message_id, name)
+        self.metrics.depth = 0
+        pending = self.store.pending_notifications()
+        if pending:
+            logger.warning("Outbox stopped with %d notifications pending.",
+                           pending)
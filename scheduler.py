@@ -0,0 +1,177 @@
+"""
+scheduler.py
+"""
+import heapq
+import itertools
+import math
+import time
+from collections import deque
+
+SCHEDULE_MODES = ("fixed-rate", "fixed-delay")
+
+OVERRUN_POLICIES = ("skip", "coalesce", "immediate")
+
+
+class TimingStats:
+    """
+    Running statistics of a timing error in seconds, such as how late
+    checks started compared with when they were due.
+    """
+
+    def __init__(self, window=1000):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._recent = deque(maxlen=window)
+
+    def record(self, value):
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+        self._recent.append(value)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, fraction):
+        """Return the given percentile of the most recent values."""
+        if not self._recent:
+            return 0.0
+        ordered = sorted(self._recent)
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+    def __str__(self):
+        return (
+            f"checks={self.count} mean={self.mean * 1000:.1f}ms "
+            f"p50={self.percentile(0.5) * 1000:.1f}ms "
+            f"p99={self.percentile(0.99) * 1000:.1f}ms "
+            f"max={self.max * 1000:.1f}ms"
+        )
+
+
+class WatchScheduler:
+    """
+    Min-heap of watches ordered by when their next check is due.
+
+    Times are time.monotonic() values. Selecting the next due watch is
+    O(log n); rescheduling or removing a watch invalidates its old heap
+    entry, which is skipped when it reaches the top.
+
+    In fixed-rate mode a watch's checks stay on the grid of its first due
+    time plus whole intervals, however long each check takes. When a check
+    finishes after its next slot, the overrun policy applies: skip drops
+    the missed slots and waits for the next one, coalesce runs once right
+    away for all of them, and immediate runs every missed slot back to
+    back. In fixed-delay mode the next check is due one interval after the
+    previous one finished.
+    """
+
+    def __init__(self, default_interval, mode="fixed-rate",
+                 overrun="coalesce"):
+        if mode not in SCHEDULE_MODES:
+            raise ValueError(
+                f"Unknown schedule mode {mode!r}, "
+                f"expected one of {', '.join(SCHEDULE_MODES)}")
+        if overrun not in OVERRUN_POLICIES:
+            raise ValueError(
+                f"Unknown overrun policy {overrun!r}, "
+                f"expected one of {', '.join(OVERRUN_POLICIES)}")
+        self.default_interval = default_interval
+        self.mode = mode
+        self.overrun = overrun
+        self.lag = TimingStats()
+        self.cadence = TimingStats()
+        self.overruns = 0
+        self.skipped = 0
+        self._heap = []
+        self._entries = {}
+        self._sequence = itertools.count()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, watch):
+        return watch.watch_id in self._entries
+
+    def interval_of(self, watch):
+        """Return the check interval of a watch in seconds."""
+        return watch.interval or self.default_interval
+
+    def schedule(self, watch, due_at):
+        """Schedule the next check of a watch, replacing any earlier one."""
+        self.remove(watch)
+        entry = [due_at, next(self._sequence), watch]
+        self._entries[watch.watch_id] = entry
+        heapq.heappush(self._heap, entry)
+
+    def schedule_from_last_check(self, watch, now=None):
+        """Schedule a watch one interval after its last recorded check."""
+        now = time.monotonic() if now is None else now
+        due_at = now
+        if watch.last_checked_at is not None:
+            elapsed = time.time() - watch.last_checked_at
+            due_at = now + max(0.0, self.interval_of(watch) - elapsed)
+        self.schedule(watch, due_at)
+
+    def reschedule(self, watch, due_at, finished_at=None):
+        """Schedule the check after the one that was due at due_at."""
+        finished_at = time.monotonic() if finished_at is None else finished_at
+        interval = self.interval_of(watch)
+        if self.mode == "fixed-delay":
+            self.schedule(watch, finished_at + interval)
+            return
+        next_due_at = due_at + interval
+        if next_due_at <= finished_at:
+            self.overruns += 1
+            missed = math.floor((finished_at - next_due_at) / interval)
+            if self.overrun == "skip":
+                self.skipped += missed + 1
+                next_due_at += (missed + 1) * interval
+            elif self.overrun == "coalesce":
+                self.skipped += missed
+                next_due_at += missed * interval
+        self.schedule(watch, next_due_at)
+
+    def remove(self, watch):
+        """Stop scheduling a watch."""
+        entry = self._entries.pop(watch.watch_id, None)
+        if entry is not None:
+            entry[2] = None
+
+    def _discard_removed(self):
+        while self._heap and self._heap[0][2] is None:
+            heapq.heappop(self._heap)
+
+    def next_due_at(self):
+        """Return when the earliest check is due, or None if none is."""
+        self._discard_removed()
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now=None, limit=None):
+        """
+        Remove and return the (watch, due_at) pairs that are due, recording
+        how late each one is and how far the time since its previous start
+        is from its interval. The caller reschedules them after the check.
+        """
+        now = time.monotonic() if now is None else now
+        due = []
+        while self._heap and (limit is None or len(due) < limit):
+            due_at, _, watch = self._heap[0]
+            if watch is None:
+                heapq.heappop(self._heap)
+                continue
+            if due_at > now:
+                break
+            heapq.heappop(self._heap)
+            del self._entries[watch.watch_id]
+            lag = now - due_at
+            watch.last_lag = lag
+            self.lag.record(lag)
+            if watch.last_started_at is not None:
+                error = (now - watch.last_started_at) - self.interval_of(watch)
+                watch.cadence_error = error
+                self.cadence.record(abs(error))
+            watch.last_started_at = now
+            due.append((watch, due_at))
+        return due
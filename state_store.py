@@ -0,0 +1,506 @@
+"""
+state_store.py
+"""
+import json
+import sqlite3
+import time
+from contextlib import contextmanager
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS watch_state (
+    watch_id TEXT PRIMARY KEY,
+    hash TEXT NOT NULL DEFAULT ''
+);
+CREATE TABLE IF NOT EXISTS notifications (
+    message_id TEXT PRIMARY KEY,
+    subject TEXT NOT NULL,
+    body TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    next_attempt_at REAL NOT NULL,
+    sent_at REAL,
+    last_error TEXT
+);
+CREATE INDEX IF NOT EXISTS notifications_due
+    ON notifications (status, next_attempt_at);
+CREATE TABLE IF NOT EXISTS deliveries (
+    message_id TEXT NOT NULL,
+    channel TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    sent_at REAL,
+    last_error TEXT,
+    PRIMARY KEY (message_id, channel)
+);
+CREATE INDEX IF NOT EXISTS deliveries_due
+    ON deliveries (channel, status, next_attempt_at);
+CREATE TABLE IF NOT EXISTS digest_events (
+    event_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    message_id TEXT UNIQUE,
+    recipient TEXT NOT NULL,
+    site TEXT NOT NULL,
+    subject TEXT NOT NULL,
+    body TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS digest_events_recipient
+    ON digest_events (recipient, event_id);
+"""
+
+# Columns added to watch_state after its first release, created on open.
+# The original hash column keeps the hex MD5 hashes of older releases; new
+# state goes to the binary fingerprint column instead.
+WATCH_STATE_COLUMNS = {
+    "content": "TEXT",
+    "etag": "TEXT",
+    "last_modified": "TEXT",
+    "last_checked_at": "REAL",
+    "fingerprint": "BLOB",
+    "fingerprint_algorithm": "TEXT",
+    "merkle": "BLOB",
+    "keyword_alerts": "TEXT",
+    "incidents": "TEXT",
+}
+
+WATCH_STATE_FIELDS = tuple(WATCH_STATE_COLUMNS)
+
+# Columns added to notifications later. channels holds the names of the
+# channels a notification goes to, comma-separated, or NULL for all of
+# them; delivered lists the channels that already have it, each followed
+# by a comma. Newer releases track each channel in deliveries instead and
+# read delivered only to carry over notifications queued before.
+NOTIFICATION_COLUMNS = {
+    "channels": "TEXT",
+    "delivered": "TEXT NOT NULL DEFAULT ''",
+    "recipients": "TEXT",
+    "url": "TEXT",
+    "diff": "TEXT",
+}
+
+# Columns added to digest_events later. channel names the channel a digest
+# goes to, or is NULL, for events of older releases, for every channel.
+DIGEST_EVENT_COLUMNS = {
+    "channel": "TEXT",
+}
+
+# Watch state fields holding dicts, stored as JSON text.
+JSON_FIELDS = frozenset({"keyword_alerts", "incidents"})
+
+
+def _encode(field, value):
+    if field in JSON_FIELDS and value is not None:
+        return json.dumps(value, sort_keys=True)
+    return value
+
+
+def _decode(field, value):
+    if field in JSON_FIELDS and value is not None:
+        return json.loads(value)
+    return value
+
+
+class StoredNotification:
+    """
+    A notification row loaded from the store.
+    """
+
+    def __init__(self, message_id, subject, body, attempts, created_at,
+                 channels=None, recipients=None, url=None, diff=None):
+        self.message_id = message_id
+        self.subject = subject
+        self.body = body
+        self.attempts = attempts
+        self.created_at = created_at
+        self.channels = channels.split(",") if channels else None
+        self.recipients = recipients.split(",") if recipients else None
+        self.url = url
+        self.diff = diff
+
+
+class StateStore:
+    """
+    SQLite database holding watch state and the durable notification queue.
+
+    Watch state is written in batches: queue_watch_state() buffers the
+    state of a checked watch and flush() commits the buffer in a single
+    transaction. save_watch_state() writes immediately, for changes that
+    must commit together with their notification.
+
+    Events waiting for a digest are kept in digest_events until the digest
+    that contains them is enqueued as a notification.
+
+    A notification has one delivery row per channel it goes to. Delivery
+    rows move from pending to claimed when the sender of their channel takes
+    them and to sent, dropped or failed when they are done, and the
+    notification is finished once all of its deliveries are. Claimed rows
+    left behind by a crash go back to pending on open.
+    """
+
+    def __init__(self, path="changecatcher.db", batch_size=500):
+        self.path = path
+        self.batch_size = batch_size
+        self._connection = sqlite3.connect(path, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(SCHEMA)
+        self._migrate()
+        self._depth = 0
+        self._pending_states = {}
+        self._connection.execute(
+            "UPDATE notifications SET status = 'pending' "
+            "WHERE status = 'claimed'")
+        self._connection.execute(
+            "UPDATE deliveries SET status = 'pending' "
+            "WHERE status = 'claimed'")
+
+    def _migrate(self):
+        """Add columns missing from databases of older releases."""
+        for table, columns in (("watch_state", WATCH_STATE_COLUMNS),
+                               ("notifications", NOTIFICATION_COLUMNS),
+                               ("digest_events", DIGEST_EVENT_COLUMNS)):
+            existing = {
+                row[1] for row in
+                self._connection.execute(f"PRAGMA table_info({table})")
+            }
+            for column, column_type in columns.items():
+                if column not in existing:
+                    self._connection.execute(
+                        f"ALTER TABLE {table} ADD COLUMN {column} "
+                        f"{column_type}")
+
+    @contextmanager
+    def transaction(self):
+        """Group every write inside the block into one atomic commit."""
+        if self._depth:
+            self._depth += 1
+            try:
+                yield
+            finally:
+                self._depth -= 1
+            return
+        self._connection.execute("BEGIN IMMEDIATE")
+        self._depth = 1
+        try:
+            yield
+        except BaseException:
+            self._connection.execute("ROLLBACK")
+            raise
+        else:
+            self._connection.execute("COMMIT")
+        finally:
+            self._depth = 0
+
+    def close(self):
+        """Flush buffered watch state and close the database."""
+        self.flush()
+        self._connection.close()
+
+    @staticmethod
+    def _state_row(watch):
+        return (watch.watch_id,) + tuple(
+            _encode(field, getattr(watch, field))
+            for field in WATCH_STATE_FIELDS)
+
+    def _write_states(self, rows):
+        columns = ", ".join(WATCH_STATE_FIELDS)
+        updates = ", ".join(
+            f"{field} = excluded.{field}" for field in WATCH_STATE_FIELDS)
+        placeholders = ", ".join("?" * (len(WATCH_STATE_FIELDS) + 1))
+        self._connection.executemany(
+            f"INSERT INTO watch_state (watch_id, {columns}) "
+            f"VALUES ({placeholders}) "
+            f"ON CONFLICT (watch_id) DO UPDATE SET {updates}",
+            rows,
+        )
+
+    def save_watch_state(self, watch):
+        """Write the state of a watch now, replacing any buffered state."""
+        self._pending_states.pop(watch.watch_id, None)
+        self._write_states([self._state_row(watch)])
+
+    def queue_watch_state(self, watch):
+        """Buffer the state of a watch, flushing once the batch is full."""
+        self._pending_states[watch.watch_id] = self._state_row(watch)
+        if len(self._pending_states) >= self.batch_size:
+            self.flush()
+
+    @property
+    def buffered_states(self):
+        """Return the number of watch states waiting for the next flush."""
+        return len(self._pending_states)
+
+    def flush(self):
+        """Commit every buffered watch state in one transaction."""
+        if not self._pending_states:
+            return
+        rows = list(self._pending_states.values())
+        self._pending_states.clear()
+        with self.transaction():
+            self._write_states(rows)
+
+    def load_watch_states(self):
+        """
+        Return the stored state of every watch, keyed by watch id. Each
+        state also holds the legacy MD5 hash under "hash".
+        """
+        fields = ("hash",) + WATCH_STATE_FIELDS
+        columns = ", ".join(fields)
+        return {
+            row[0]: {field: _decode(field, value)
+                     for field, value in zip(fields, row[1:], strict=True)}
+            for row in self._connection.execute(
+                f"SELECT watch_id, {columns} FROM watch_state")
+        }
+
+    def enqueue_notification(self, message_id, subject, body, channels,
+                             recipients=None, url=None, diff=None):
+        """
+        Store a notification, with a pending delivery on each of the named
+        channels, for the given recipients, or the configured ones, with the
+        page url and the diff of the change, if any. Returns False when a
+        notification with the same message id already exists, so repeated
+        enqueues are no-ops.
+        """
+        now = time.time()
+        with self.transaction():
+            cursor = self._connection.execute(
+                "INSERT OR IGNORE INTO notifications "
+                "(message_id, subject, body, status, created_at, "
+                "next_attempt_at, channels, recipients, url, diff) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (message_id, subject, body,
+                 "pending" if channels else "sent", now, now,
+                 ",".join(channels) if channels else None,
+                 ",".join(recipients) if recipients else None, url, diff),
+            )
+            if cursor.rowcount != 1:
+                return False
+            self._connection.executemany(
+                "INSERT INTO deliveries (message_id, channel, next_attempt_at) "
+                "VALUES (?, ?, ?)",
+                [(message_id, channel, now) for channel in channels],
+            )
+        return True
+
+    def prepare_deliveries(self, channels):
+        """
+        Match pending deliveries to the configured channels: notifications
+        queued by older releases, before deliveries were tracked per
+        channel, get one on each of their channels that has not delivered
+        them yet, and deliveries on channels that are no longer configured
+        are dropped.
+        """
+        with self.transaction():
+            legacy = self._connection.execute(
+                "SELECT message_id, channels, delivered, attempts, "
+                "next_attempt_at FROM notifications AS n "
+                "WHERE status = 'pending' AND NOT EXISTS ("
+                "SELECT 1 FROM deliveries AS d "
+                "WHERE d.message_id = n.message_id)"
+            ).fetchall()
+            for message_id, names, delivered, attempts, due_at in legacy:
+                done = set(filter(None, delivered.split(",")))
+                self._connection.executemany(
+                    "INSERT INTO deliveries "
+                    "(message_id, channel, attempts, next_attempt_at) "
+                    "VALUES (?, ?, ?, ?)",
+                    [(message_id, channel, attempts, due_at)
+                     for channel in (names.split(",") if names else channels)
+                     if channel in channels and channel not in done],
+                )
+                self._settle(message_id)
+            placeholders = ", ".join("?" * len(channels))
+            orphans = self._connection.execute(
+                f"SELECT DISTINCT message_id FROM deliveries "
+                f"WHERE status = 'pending' "
+                f"AND channel NOT IN ({placeholders})",
+                tuple(channels),
+            ).fetchall()
+            self._connection.execute(
+                f"UPDATE deliveries SET status = 'dropped', "
+                f"last_error = 'channel not configured' "
+                f"WHERE status = 'pending' "
+                f"AND channel NOT IN ({placeholders})",
+                tuple(channels),
+            )
+            for (message_id,) in orphans:
+                self._settle(message_id)
+
+    def claim_due_deliveries(self, channel, limit):
+        """
+        Claim and return up to limit notifications whose delivery on a
+        channel is due, each with the attempts made on that channel.
+        """
+        with self.transaction():
+            rows = self._connection.execute(
+                "SELECT n.message_id, n.subject, n.body, d.attempts, "
+                "n.created_at, n.channels, n.recipients, n.url, n.diff "
+                "FROM deliveries AS d JOIN notifications AS n "
+                "ON n.message_id = d.message_id "
+                "WHERE d.channel = ? AND d.status = 'pending' "
+                "AND d.next_attempt_at <= ? "
+                "ORDER BY d.next_attempt_at LIMIT ?",
+                (channel, time.time(), limit),
+            ).fetchall()
+            self._connection.executemany(
+                "UPDATE deliveries SET status = 'claimed' "
+                "WHERE message_id = ? AND channel = ?",
+                [(row[0], channel) for row in rows],
+            )
+        return [StoredNotification(*row) for row in rows]
+
+    def _settle(self, message_id):
+        """
+        Finish a notification once none of its deliveries is left: as sent
+        when every channel delivered it, and otherwise as failed or dropped,
+        with the errors of the channels that did not.
+        """
+        rows = self._connection.execute(
+            "SELECT channel, status, last_error FROM deliveries "
+            "WHERE message_id = ?",
+            (message_id,),
+        ).fetchall()
+        statuses = {status for _, status, _ in rows}
+        if statuses & {"pending", "claimed"}:
+            return
+        if "failed" in statuses:
+            status = "failed"
+        elif "dropped" in statuses:
+            status = "dropped"
+        else:
+            status = "sent"
+        error = "; ".join(
+            f"{channel}: {last_error}" for channel, delivery, last_error in rows
+            if delivery != "sent" and last_error)
+        self._connection.execute(
+            "UPDATE notifications SET status = ?, sent_at = ?, last_error = ? "
+            "WHERE message_id = ?",
+            (status, time.time() if status == "sent" else None, error or None,
+             message_id),
+        )
+
+    def mark_sent(self, message_id, channel):
+        """Record that a channel delivered a notification."""
+        with self.transaction():
+            self._connection.execute(
+                "UPDATE deliveries SET status = 'sent', sent_at = ? "
+                "WHERE message_id = ? AND channel = ?",
+                (time.time(), message_id, channel),
+            )
+            self._settle(message_id)
+
+    def mark_retry(self, message_id, channel, attempts, next_attempt_at,
+                   error):
+        """Put a delivery back to pending after a failed attempt."""
+        self._connection.execute(
+            "UPDATE deliveries SET status = 'pending', attempts = ?, "
+            "next_attempt_at = ?, last_error = ? "
+            "WHERE message_id = ? AND channel = ?",
+            (attempts, next_attempt_at, error, message_id, channel),
+        )
+
+    def mark_done(self, message_id, channel, status, error=None):
+        """Finish a delivery as dropped or failed."""
+        with self.transaction():
+            self._connection.execute(
+                "UPDATE deliveries SET status = ?, last_error = ? "
+                "WHERE message_id = ? AND channel = ?",
+                (status, error, message_id, channel),
+            )
+            self._settle(message_id)
+
+    def release_notification(self, message_id, channel):
+        """Return a claimed delivery to pending."""
+        self._connection.execute(
+            "UPDATE deliveries SET status = 'pending' "
+            "WHERE message_id = ? AND channel = ? AND status = 'claimed'",
+            (message_id, channel),
+        )
+
+    def prune_notifications(self, older_than):
+        """Delete finished notifications created before the given time."""
+        with self.transaction():
+            self._connection.execute(
+                "DELETE FROM notifications "
+                "WHERE status IN ('sent', 'dropped', 'failed') "
+                "AND created_at < ?",
+                (older_than,),
+            )
+            self._connection.execute(
+                "DELETE FROM deliveries WHERE message_id NOT IN "
+                "(SELECT message_id FROM notifications)")
+
+    def pending_notifications(self):
+        """Return the number of notifications not yet finished."""
+        return self._connection.execute(
+            "SELECT COUNT(*) FROM notifications WHERE status = 'pending'"
+        ).fetchone()[0]
+
+    def pending_deliveries(self, channel=None):
+        """
+        Return the number of deliveries waiting in the store, on one
+        channel or on all of them.
+        """
+        return self._connection.execute(
+            "SELECT COUNT(*) FROM deliveries WHERE status = 'pending' "
+            "AND (? IS NULL OR channel = ?)",
+            (channel, channel),
+        ).fetchone()[0]
+
+    def next_due_at(self, channel=None):
+        """
+        Return when the earliest pending delivery, on one channel or on
+        any of them, becomes due.
+        """
+        return self._connection.execute(
+            "SELECT MIN(next_attempt_at) FROM deliveries "
+            "WHERE status = 'pending' AND (? IS NULL OR channel = ?)",
+            (channel, channel),
+        ).fetchone()[0]
+
+    def add_digest_event(self, recipient, site, subject, body,
+                         message_id=None, created_at=None, channel=None):
+        """
+        Store an event for the next digest of a recipient on a channel.
+        Returns False when an event with the same message id is already
+        waiting.
+        """
+        cursor = self._connection.execute(
+            "INSERT OR IGNORE INTO digest_events "
+            "(message_id, recipient, site, subject, body, created_at, "
+            "channel) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (message_id, recipient, site, subject, body,
+             created_at or time.time(), channel),
+        )
+        return cursor.rowcount == 1
+
+    def digest_backlog(self):
+        """
+        Return (recipient, channel, waiting events, oldest created_at) for
+        every recipient and channel with events waiting for a digest.
+        """
+        return self._connection.execute(
+            "SELECT recipient, channel, COUNT(*), MIN(created_at) "
+            "FROM digest_events GROUP BY recipient, channel"
+        ).fetchall()
+
+    def digest_events(self, recipient, channel, limit):
+        """
+        Return the oldest waiting events of a recipient on a channel as
+        (event_id, site, subject, body, created_at) rows.
+        """
+        return self._connection.execute(
+            "SELECT event_id, site, subject, body, created_at "
+            "FROM digest_events WHERE recipient = ? AND channel IS ? "
+            "ORDER BY event_id LIMIT ?",
+            (recipient, channel, limit),
+        ).fetchall()
+
+    def delete_digest_events(self, event_ids):
+        """Delete events that went out in a digest."""
+        self._connection.executemany(
+            "DELETE FROM digest_events WHERE event_id = ?",
+            [(event_id,) for event_id in event_ids],
+        )
@@ -0,0 +1,15 @@
+"""
+Shared fixtures of the tests.
+"""
+import pytest
+
+from email_notifier import close_smtp_pools
+from tests.smtp_stand_in import LocalSMTPServer
+
+
+@pytest.fixture
+def smtp_server():
+    """A running SMTP stand-in, with the SMTP pools closed afterwards."""
+    with LocalSMTPServer() as server:
+        yield server
+        close_smtp_pools()
@@ -0,0 +1,99 @@
+"""
+smtp_stand_in.py
+
+A local SMTP server for the tests and benchmarks.
+"""
+import socketserver
+import threading
+import time
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    """Speak just enough SMTP for smtplib to deliver messages."""
+
+    @property
+    def stand_in(self):
+        """Return the LocalSMTPServer this handler serves."""
+        server = self.server
+        assert isinstance(server, LocalSMTPServer)
+        return server
+
+    def _reply(self, *lines):
+        time.sleep(self.stand_in.latency)
+        self.wfile.write("".join(line + "\r\n" for line in lines).encode())
+
+    def handle(self):
+        self._reply("220 localhost ESMTP stand-in")
+        recipients = []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode().strip()
+            verb = command[:4].upper()
+            if verb == "EHLO":
+                self._reply("250-localhost", "250 AUTH PLAIN LOGIN")
+            elif verb == "HELO":
+                self._reply("250 localhost")
+            elif verb == "AUTH":
+                self._reply("235 Authentication successful")
+            elif verb == "RCPT":
+                address = command.partition(":")[2].strip(" <>")
+                if address in self.stand_in.refused:
+                    self._reply("550 No such user")
+                else:
+                    recipients.append(address)
+                    self._reply("250 OK")
+            elif verb == "DATA":
+                self._reply("354 End data with <CR><LF>.<CR><LF>")
+                while self.rfile.readline() not in (b".\r\n", b""):
+                    pass
+                self.stand_in.record(recipients)
+                recipients = []
+                self._reply("250 OK")
+            elif verb == "QUIT":
+                self._reply("221 Bye")
+                return
+            elif verb == "RSET":
+                recipients = []
+                self._reply("250 OK")
+            else:
+                self._reply("250 OK")
+
+
+class LocalSMTPServer(socketserver.ThreadingTCPServer):
+    """
+    SMTP stand-in on localhost that accepts every message, except for
+    the recipients listed in refused.
+
+    latency is added before every reply to model the round trip to a real
+    mail server.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, latency=0.0, refused=()):
+        super().__init__(("127.0.0.1", 0), _SMTPHandler)
+        self.latency = latency
+        self.refused = frozenset(refused)
+        self.messages = 0
+        self.deliveries = []
+        self._lock = threading.Lock()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def record(self, recipients):
+        with self._lock:
+            self.messages += 1
+            self.deliveries.append(list(recipients))
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
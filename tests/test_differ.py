@@ -0,0 +1,70 @@
+"""
+Property tests of the token diff algorithms against random sequences.
+"""
+import random
+
+import pytest
+
+from differ import DIFF_ALGORITHMS, DiffTooLarge, diff_tokens
+
+
+def _lcs_length(a, b):
+    """Length of the longest common subsequence, by dynamic programming."""
+    row = [0] * (len(b) + 1)
+    for token in a:
+        diagonal = 0
+        for j, other in enumerate(b):
+            diagonal, row[j + 1] = row[j + 1], (
+                diagonal + 1 if token == other else max(row[j + 1], row[j]))
+    return row[-1]
+
+
+def _sequences(count, seed):
+    rng = random.Random(seed)
+    for _ in range(count):
+        alphabet = "abcd"[:rng.randint(1, 4)]
+        yield ([rng.choice(alphabet) for _ in range(rng.randint(0, 30))],
+               [rng.choice(alphabet) for _ in range(rng.randint(0, 30))])
+
+
+def _check_opcodes(a, b, ops):
+    """Check that the opcodes cover a and b in order and rebuild b."""
+    i = j = 0
+    rebuilt = []
+    for op, i1, i2, j1, j2 in ops:
+        assert (i1, j1) == (i, j)
+        if op == "equal":
+            assert a[i1:i2] == b[j1:j2]
+            rebuilt += a[i1:i2]
+        elif op == "delete":
+            assert j1 == j2 and i1 < i2
+        else:
+            assert op == "insert" and i1 == i2 and j1 < j2
+            rebuilt += b[j1:j2]
+        i, j = i2, j2
+    assert (i, j) == (len(a), len(b))
+    assert rebuilt == b
+    return sum(i2 - i1 + j2 - j1 for op, i1, i2, j1, j2 in ops
+               if op != "equal")
+
+
+@pytest.mark.parametrize("algorithm", DIFF_ALGORITHMS)
+def test_opcodes_rebuild_b(algorithm):
+    for a, b in _sequences(2000, seed=1):
+        ops = diff_tokens(a, b, algorithm, timeout=60, max_edits=100)
+        edits = _check_opcodes(a, b, ops)
+        # No diff can do better than the longest common subsequence.
+        assert edits >= len(a) + len(b) - 2 * _lcs_length(a, b)
+
+
+def test_myers_is_minimal():
+    for a, b in _sequences(2000, seed=2):
+        ops = diff_tokens(a, b, "myers", timeout=60, max_edits=100)
+        assert (_check_opcodes(a, b, ops)
+                == len(a) + len(b) - 2 * _lcs_length(a, b))
+
+
+@pytest.mark.parametrize("algorithm", DIFF_ALGORITHMS)
+def test_too_many_edits_are_refused(algorithm):
+    with pytest.raises(DiffTooLarge):
+        diff_tokens(list("a" * 50), list("b" * 50), algorithm, max_edits=10)
@@ -0,0 +1,47 @@
+"""
+Tests of the digest batcher.
+"""
+from digest import DigestBatcher
+from state_store import StateStore
+
+
+class RecordingOutbox:
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, subject, body, message_id=None, channels=None,
+               recipients=None):
+        del body, message_id
+        self.submitted.append((subject, channels, recipients))
+        return True
+
+
+def test_digests_go_to_the_channels_of_their_events(tmp_path):
+    store = StateStore(str(tmp_path / "state.db"))
+    outbox = RecordingOutbox()
+    digest = DigestBatcher(outbox, store)
+    digest.submit(["email"], ["a@localhost", "b@localhost"],
+                  "https://example.com/1", "Content Updated", "<p>1</p>", "m1")
+    digest.submit(["email", "ops"], ["a@localhost"],
+                  "https://example.com/2", "Keyword Detected", "<p>2</p>",
+                  "m2")
+    digest.flush(force=True)
+    assert sorted(outbox.submitted) == [
+        ("Digest: 1 event on 1 site", ["email"], ["b@localhost"]),
+        ("Digest: 1 event on 1 site", ["ops"], ["a@localhost"]),
+        ("Digest: 2 events on 2 sites", ["email"], ["a@localhost"]),
+    ]
+    assert store.digest_backlog() == []
+    store.close()
+
+
+def test_repeated_events_are_not_digested_twice(tmp_path):
+    store = StateStore(str(tmp_path / "state.db"))
+    digest = DigestBatcher(RecordingOutbox(), store)
+    assert digest.submit(["email"], ["a@localhost"], "https://example.com",
+                         "Content Updated", "<p>1</p>", "m1")
+    assert not digest.submit(["email"], ["a@localhost"],
+                             "https://example.com", "Content Updated",
+                             "<p>1</p>", "m1")
+    assert digest.metrics.duplicates == 1
+    store.close()
@@ -0,0 +1,116 @@
+"""
+Tests of notification emails against a local SMTP stand-in.
+"""
+import asyncio
+
+import pytest
+
+from channels import DeliveryRefused, SMTPChannel
+from config import Config
+from email_notifier import send_notification_email
+from outbox import NotificationOutbox
+from state_store import StateStore
+
+
+@pytest.fixture
+def config(smtp_server, tmp_path):
+    return Config(
+        smtp_server="127.0.0.1",
+        smtp_port=smtp_server.port,
+        username="user",
+        password="password",
+        sender="monitor@localhost",
+        recipient="a@localhost, b@localhost,a@localhost",
+        smtp_starttls=False,
+        smtp_timeout=5,
+        state_path=str(tmp_path / "state.db"),
+        display=False,
+    )
+
+
+def test_one_message_to_every_recipient(smtp_server, config):
+    send_notification_email("Content Updated", "<p>New content</p>", config,
+                            message_id="m1")
+    assert smtp_server.messages == 1
+    assert smtp_server.deliveries == [["a@localhost", "b@localhost"]]
+
+
+def test_subscribers_replace_configured_recipients(smtp_server, config):
+    send_notification_email("Content Updated", "<p>New content</p>", config,
+                            recipients=["c@localhost", "d@localhost"])
+    send_notification_email("Content Updated", "<p>New content</p>", config)
+    assert smtp_server.messages == 2
+    assert smtp_server.deliveries == [
+        ["c@localhost", "d@localhost"],
+        ["a@localhost", "b@localhost"],
+    ]
+
+
+def test_smtp_channel_sends_stored_notifications(smtp_server, config):
+    store = StateStore(config.state_path)
+    store.enqueue_notification("m1", "Keyword Detected", "<p>ticket</p>",
+                               ["email"], url="https://example.com")
+    store.enqueue_notification("m2", "Content Updated", "<p>New content</p>",
+                               ["email"], recipients=["c@localhost", "d@localhost"],
+                               url="https://example.com", diff="<ul></ul>")
+    notifications = store.claim_due_deliveries("email", 10)
+    store.close()
+    channel = SMTPChannel()
+
+    async def deliver():
+        for notification in notifications:
+            await channel.deliver(notification, config)
+
+    asyncio.run(deliver())
+    assert channel.metrics.sent == 2
+    assert smtp_server.messages == 2
+    assert sorted(smtp_server.deliveries) == [
+        ["a@localhost", "b@localhost"],
+        ["c@localhost", "d@localhost"],
+    ]
+
+
+def test_refused_recipients_are_returned(smtp_server, config):
+    smtp_server.refused = frozenset({"bad@localhost"})
+    refused = send_notification_email(
+        "Content Updated", "<p>New content</p>", config, message_id="m1",
+        recipients=["a@localhost", "bad@localhost"])
+    assert list(refused) == ["bad@localhost"]
+    assert refused["bad@localhost"][0] == 550
+    assert smtp_server.deliveries == [["a@localhost"]]
+
+
+def test_refused_recipients_fail_the_delivery(smtp_server, config):
+    smtp_server.refused = frozenset({"bad@localhost"})
+    store = StateStore(config.state_path)
+    channel = SMTPChannel()
+    outbox = NotificationOutbox([channel], config, store, retry_base=1)
+
+    async def run():
+        outbox.start()
+        outbox.submit("Content Updated", "<p>New content</p>", "m1",
+                      recipients=["a@localhost", "bad@localhost"])
+        await asyncio.sleep(0.5)
+        await outbox.stop(timeout=0)
+
+    asyncio.run(run())
+    assert smtp_server.deliveries == [["a@localhost"]]
+    assert outbox.metrics.sent == 0
+    assert outbox.metrics.retried == 0
+    assert outbox.metrics.failed == 1
+    assert store.pending_notifications() == 0
+    store.close()
+
+
+def test_smtp_channel_raises_on_refused_recipients(smtp_server, config):
+    smtp_server.refused = frozenset({"bad@localhost"})
+    store = StateStore(config.state_path)
+    store.enqueue_notification("m1", "Content Updated", "<p>New content</p>",
+                               ["email"],
+                               recipients=["a@localhost", "bad@localhost"])
+    notification, = store.claim_due_deliveries("email", 10)
+    store.close()
+    channel = SMTPChannel()
+    with pytest.raises(DeliveryRefused, match="bad@localhost"):
+        asyncio.run(channel.deliver(notification, config))
+    assert channel.metrics.failed == 1
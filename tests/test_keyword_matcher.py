@@ -0,0 +1,58 @@
+"""
+Property tests of the keyword automaton against a naive str.find scan.
+"""
+import random
+
+import pytest
+
+import keyword_matcher
+from keyword_matcher import KeywordMatcher
+
+
+def _naive(keywords, text):
+    """Every occurrence of every keyword, overlapping ones included."""
+    text = text.casefold()
+    found = set()
+    for keyword in {keyword.casefold() for keyword in keywords if keyword}:
+        start = text.find(keyword)
+        while start != -1:
+            found.add((keyword, start, start + len(keyword)))
+            start = text.find(keyword, start + 1)
+    return found
+
+
+@pytest.fixture(params=["python", "pyahocorasick"])
+def implementation(request, monkeypatch):
+    if request.param == "python":
+        monkeypatch.setattr(keyword_matcher, "ahocorasick", None)
+    elif keyword_matcher.ahocorasick is None:
+        pytest.skip("pyahocorasick is not installed")
+    return request.param
+
+
+@pytest.mark.usefixtures("implementation")
+def test_automaton_matches_naive_scan():
+    rng = random.Random(5)
+    for _ in range(2000):
+        alphabet = "abcA"[:rng.randint(1, 4)]
+        keywords = ["".join(rng.choice(alphabet)
+                            for _ in range(rng.randint(1, 4)))
+                    for _ in range(rng.randint(1, 5))]
+        text = "".join(rng.choice(alphabet + "x ")
+                       for _ in range(rng.randint(0, 40)))
+        matches = KeywordMatcher(keywords).find_all(text)
+        expected = _naive(keywords, text)
+        assert {(match.keyword, match.start, match.end)
+                for match in matches} == expected
+        assert len(matches) == len(expected)
+        ends = [match.end for match in matches]
+        assert ends == sorted(ends)
+
+
+@pytest.mark.usefixtures("implementation")
+def test_matching_ignores_case():
+    matcher = KeywordMatcher(["Ticket", "BIRD"])
+    assert matcher.matches("No TICKETS, one bird.") == {
+        "ticket": [(3, 9)],
+        "bird": [(16, 20)],
+    }
@@ -0,0 +1,37 @@
+"""
+Tests of the section normalizer on canonical markup.
+"""
+import pytest
+
+from extractor import available_backends, extract_element
+from normalizer import COMMON_SCRUBBERS, Normalizer
+
+
+def _page(query):
+    return (f"<html><body><section id='welcome'><p>Tickets</p>"
+            f"<img src='/a.png?{query}'></section></body></html>")
+
+
+@pytest.mark.parametrize("backend", available_backends())
+@pytest.mark.parametrize("first, second", [
+    ("t=111", "t=222"),
+    ("size=2&t=111", "size=2&t=222"),
+    ("size=2&amp;v=1.0.1&amp;lang=en", "size=2&amp;v=1.0.2&amp;lang=en"),
+])
+def test_cache_busters_are_scrubbed(backend, first, second):
+    normalizer = Normalizer(scrubbers=COMMON_SCRUBBERS)
+    sections = [extract_element(_page(query), "welcome", backend=backend)
+                for query in (first, second)]
+    assert sections[0] != sections[1]
+    assert (normalizer.normalize(sections[0])
+            == normalizer.normalize(sections[1]))
+    assert normalizer.hits["scrub:cache-busting"] == 2
+
+
+def test_other_query_parameters_are_kept():
+    normalizer = Normalizer(scrubbers=COMMON_SCRUBBERS)
+    sections = [extract_element(_page(f"size={size}&t=111"), "welcome",
+                                backend="html.parser")
+                for size in (2, 3)]
+    assert (normalizer.normalize(sections[0])
+            != normalizer.normalize(sections[1]))
@@ -0,0 +1,66 @@
+"""
+Tests of the notification outbox.
+"""
+import asyncio
+
+from channels import Channel
+from outbox import NotificationOutbox
+from state_store import StateStore
+
+
+class RecordingChannel(Channel):
+    def __init__(self, name, timeout=5):
+        super().__init__(name, timeout)
+        self.subjects = []
+
+    async def send(self, notification, config):
+        del config
+        self.subjects.append(notification.subject)
+
+
+class HungChannel(Channel):
+    async def send(self, notification, config):
+        del notification, config
+        await asyncio.sleep(3600)
+
+
+def test_hung_channel_does_not_hold_up_others(tmp_path):
+    store = StateStore(str(tmp_path / "state.db"))
+    email = RecordingChannel("email")
+    outbox = NotificationOutbox([email, HungChannel("hook", 1)], None, store,
+                                workers=2, retry_base=60)
+
+    async def run():
+        outbox.start()
+        for index in range(6):
+            outbox.submit(f"Notification {index}", "<p>body</p>")
+        await asyncio.sleep(0.5)
+        await outbox.stop(timeout=0)
+
+    asyncio.run(run())
+    assert sorted(email.subjects) == [f"Notification {index}"
+                                      for index in range(6)]
+    assert store.pending_deliveries("email") == 0
+    assert store.pending_notifications() == 6
+    store.close()
+
+
+def test_retry_only_goes_to_the_failed_channel(tmp_path):
+    store = StateStore(str(tmp_path / "state.db"))
+    email = RecordingChannel("email")
+    outbox = NotificationOutbox([email, HungChannel("hook", 0.1)], None,
+                                store, max_attempts=2, retry_base=1)
+
+    async def run():
+        outbox.start()
+        outbox.submit("Content Updated", "<p>body</p>", message_id="m1")
+        await asyncio.sleep(1.5)
+        await outbox.stop(timeout=0)
+
+    asyncio.run(run())
+    assert email.subjects == ["Content Updated"]
+    assert outbox.channels["hook"].metrics.timeouts == 2
+    assert outbox.metrics.sent == 1
+    assert outbox.metrics.failed == 1
+    assert store.pending_notifications() == 0
+    store.close()
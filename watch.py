@@ -0,0 +1,68 @@
+"""
+watch.py
+"""
+from urllib.parse import urlsplit
+
+from keyword_matcher import compile_keywords
+
+
+class Watch:
+    """
+    A single monitored page and the state tracked for it between checks.
+    """
+
+    def __init__(
+        self,
+        url,
+        element_id="welcome",
+        keywords=None,
+        interval=None,
+        watch_id=None,
+        extraction_mode="full",
+        parser_backend=None,
+        normalizer=None,
+        channels=None,
+        subscribers=None,
+    ):
+        self.url = url
+        self.element_id = element_id
+        self.keywords = keywords if keywords is not None else []
+        self.interval = interval
+        self.watch_id = watch_id or url
+        self.extraction_mode = extraction_mode
+        self.parser_backend = parser_backend
+        self.normalizer = normalizer
+        # Names of the notification channels to alert on; None alerts on
+        # every channel.
+        self.channels = channels
+        # Email addresses notified about this watch; None notifies the
+        # configured recipients.
+        self.subscribers = subscribers
+        self.fingerprint: bytes | None = None
+        self.fingerprint_algorithm: str | None = None
+        self.content: str | None = None
+        self.merkle: bytes | None = None
+        # Keywords present at the last check, mapped to when they were last
+        # alerted; None until the first check.
+        self.keyword_alerts: dict | None = None
+        # Open incidents by kind, see incidents.IncidentTracker.
+        self.incidents: dict | None = None
+        self.etag: str | None = None
+        self.last_modified: str | None = None
+        self.last_checked_at: float | None = None
+        self.last_lag: float | None = None
+        self.last_started_at: float | None = None
+        self.cadence_error: float | None = None
+
+    @property
+    def keyword_matcher(self):
+        """Return the compiled matcher for the watch's keywords."""
+        return compile_keywords(self.keywords)
+
+    @property
+    def host(self):
+        """Return the host part of the watched url."""
+        return urlsplit(self.url).netloc.lower()
+
+    def __repr__(self):
+        return f"Watch({self.watch_id!r})"
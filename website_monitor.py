@@ -1,138 +1,772 @@
 """
 website_monitor.py
 """
+import asyncio
+import contextlib
+import copy
 import hashlib
-import requests
+import html
+import signal
+import time
+from collections import Counter
 
-from bs4 import BeautifulSoup
-from email_notifier import send_notification_email
+from channels import SMTPChannel
+from digest import DigestBatcher
+from differ import (
+    DIFF_ALGORITHMS,
+    DIFF_MODES,
+    DiffTimeout,
+    DiffTooLarge,
+    diff_blocks,
+    diff_markup,
+)
+from email_notifier import close_smtp_pools, send_notification_email
+from email_renderer import get_renderer
+from extractor import (
+    RAW_MODE,
+    RawSection,
+    extract_element,
+    extract_raw_element,
+    select_backend,
+)
+from fetcher import AsyncFetcher
+from fingerprint import Fingerprinter, migrate_legacy_hash
+from incidents import ONGOING, OPENED, IncidentTracker
 from logger import Logger
+from merkle import (
+    MAX_REPORTED_BLOCKS,
+    build_tree,
+    changed_blocks,
+    deserialize,
+    format_path,
+    serialize,
+)
+from outbox import NotificationOutbox
+from scheduler import WatchScheduler
+from state_store import StateStore
 
 logger = Logger.setup_logger()
 
+NOT_MODIFIED = object()
+
+ELEMENT_MISSING = object()
+
+INCIDENT_SUBJECTS = {
+    ("fetch", OPENED): "Fetch Failing",
+    ("fetch", ONGOING): "Fetch Still Failing",
+    ("missing", OPENED): "Element Missing",
+    ("missing", ONGOING): "Element Still Missing",
+}
+
+RECOVERY_SUBJECTS = {"fetch": "Fetch Recovered", "missing": "Element Restored"}
+
+STATE_FLUSH_INTERVAL = 1.0
+
+
+def _log_fields(watch, phase, started=None):
+    """Return the structured log fields of a watch, for extra=."""
+    fields = {"watch_id": watch.watch_id, "url": watch.url, "phase": phase}
+    if started is not None:
+        fields["duration_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    return fields
+
+
+def _incident_message_id(watch, kind, incident, event):
+    """Return a message id that is stable across retries of one alert."""
+    return hashlib.sha1(
+        f"{watch.watch_id}:{kind}:{incident['since']}:{event}".encode()
+    ).hexdigest()
+
+
+def _describe_incident(watch, kind, incident):
+    """Describe an incident and how long it has lasted."""
+    since = time.strftime("%Y-%m-%d %H:%M:%S",
+                          time.localtime(incident["since"]))
+    if kind == "missing":
+        what = f"Element {watch.element_id} not found at {watch.url}"
+    else:
+        what = f"{watch.url} could not be fetched"
+    failures = incident["failures"]
+    text = (f"{what} since {since}: {failures} failed "
+            f"check{'s' if failures != 1 else ''}")
+    if incident["suppressed"]:
+        text += f", {incident['suppressed']} repeated alerts suppressed"
+    return text + "."
+
 
 class WebsiteMonitor:
     """
-    WebsiteMonitor class for monitoring a website for updates.
+    WebsiteMonitor class for monitoring websites for updates.
     """
 
+    # Opened by run(), and only used while it runs.
+    store: StateStore
+    outbox: NotificationOutbox
+
     def __init__(self, config):
         """Initialize the PageMonitor with the given configuration."""
+        if config.diff_mode not in DIFF_MODES:
+            raise ValueError(
+                f"Unknown diff mode {config.diff_mode!r}, "
+                f"expected one of {', '.join(DIFF_MODES)}")
+        if config.diff_algorithm not in DIFF_ALGORITHMS:
+            raise ValueError(
+                f"Unknown diff algorithm {config.diff_algorithm!r}, "
+                f"expected one of {', '.join(DIFF_ALGORITHMS)}")
         self.config = config
-        content = self._fetch_from_url(self.config.url)
-        if content:
-            self.hash = hashlib.md5(content.encode()).hexdigest()
-            logger.info(
-                "Monitoring initialized for %s. Initial content: %s",
-                self.config.url,
-                content,
-            )
-        else:
-            self.hash = ""
-            logger.info(
-                "Monitoring initialized for %s. No initial content fetched.",
-                self.config.url,
-            )
+        self.watches = config.watches
+        self.digest = None
+        self.scheduler = WatchScheduler(config.interval,
+                                        mode=config.schedule_mode,
+                                        overrun=config.overrun_policy)
+        self.fingerprinter = Fingerprinter(config.fingerprint_algorithm)
+        self.incident_tracker = IncidentTracker(
+            windows={"fetch": config.fetch_alert_window,
+                     "missing": config.missing_alert_window},
+            thresholds={"fetch": config.fetch_failure_threshold,
+                        "missing": config.missing_failure_threshold},
+        )
+        self._checks = set()
+        self._wakeup = asyncio.Event()
+        self._shutdown = asyncio.Event()
+        self._reload_requested = False
 
-    def _fetch_from_url(self, url: str, element_id: str = "welcome"):
-        """Fetch content from the given url and extract the specified element."""
-        try:
-            response = requests.get(url, timeout=self.config.timeout)
-        except requests.RequestException as e:
-            logger.error("Fetch Failed: %s. Error: %s", url, str(e))
+    def request_shutdown(self):
+        """Stop dispatching checks and let run() shut down cleanly."""
+        self._shutdown.set()
+        self._wakeup.set()
+
+    def request_reload(self):
+        """Check every watch now and report status, as on SIGHUP."""
+        self._reload_requested = True
+        self._wakeup.set()
+
+    def _install_signal_handlers(self):
+        """Route SIGINT/SIGTERM to shutdown and SIGHUP to reload."""
+        loop = asyncio.get_running_loop()
+        handlers = {
+            signal.SIGINT: self.request_shutdown,
+            signal.SIGTERM: self.request_shutdown,
+        }
+        if hasattr(signal, "SIGHUP"):
+            handlers[signal.SIGHUP] = self.request_reload
+        installed = []
+        for signum, handler in handlers.items():
+            try:
+                loop.add_signal_handler(signum, handler)
+            except (NotImplementedError, RuntimeError, ValueError):
+                continue
+            installed.append(signum)
+        return installed
+
+    def _create_fetcher(self):
+        """Create the fetcher shared by every watch."""
+        return AsyncFetcher(
+            max_connections=self.config.max_connections,
+            max_connections_per_host=self.config.max_connections_per_host,
+            timeout=self.config.timeout,
+        )
+
+    async def _initialize(self, fetcher):
+        """
+        Restore every watch from the state store, and fetch a baseline for
+        the watches that have no stored state yet.
+        """
+        states = self.store.load_watch_states()
+        unknown = []
+        for watch in self.watches:
+            state = states.get(watch.watch_id)
+            if state is None:
+                unknown.append(watch)
+                continue
+            legacy_hash = state.pop("hash")
+            for field, value in state.items():
+                setattr(watch, field, value)
+            migrate_legacy_hash(watch, legacy_hash)
+        if len(unknown) < len(self.watches):
+            logger.info("Restored state of %d watches from %s.",
+                        len(self.watches) - len(unknown), self.store.path)
+
+        contents = await asyncio.gather(
+            *(self._fetch_from_url(fetcher, watch) for watch in unknown))
+        trees = [
+            await asyncio.to_thread(self._build_tree, str(content))
+            if content and content is not ELEMENT_MISSING else None
+            for content in contents
+        ]
+        with self.store.transaction():
+            for watch, content, tree in zip(unknown, contents, trees,
+                                            strict=True):
+                if content and content is not ELEMENT_MISSING:
+                    watch.fingerprint = self.fingerprinter.digest(
+                        self._fingerprint_data(content))
+                    watch.fingerprint_algorithm = self.fingerprinter.algorithm
+                    watch.content = content = str(content)
+                    watch.merkle = serialize(tree) if tree else None
+                    logger.info(
+                        "Monitoring initialized for %s. Initial content: %s",
+                        watch.url,
+                        Logger.preview(content),
+                        extra=_log_fields(watch, "initialize"),
+                    )
+                    self._check_keywords(
+                        watch, self._find_keywords(content, watch))
+                else:
+                    watch.fingerprint = watch.fingerprint_algorithm = None
+                    logger.info(
+                        "Monitoring initialized for %s. "
+                        "No initial content fetched.",
+                        watch.url,
+                        extra=_log_fields(watch, "initialize"),
+                    )
+                watch.last_checked_at = time.time()
+                self.store.save_watch_state(watch)
+
+    async def _fetch_from_url(self, fetcher, watch):
+        """Fetch content from the watched url and extract the specified element."""
+        url = watch.url
+        started = time.perf_counter()
+        result = await fetcher.fetch(url, watch.etag, watch.last_modified)
+        if result.not_modified:
+            logger.debug("Content of %s not modified since last check", url,
+                         extra=_log_fields(watch, "fetch", started))
+            return NOT_MODIFIED
+
+        if result.error is not None:
+            logger.error("Fetch Failed: %s. Error: %s", url, str(result.error),
+                         extra=_log_fields(watch, "fetch", started))
             return None
 
-        if response.status_code != 200:
+        if result.status != 200:
             logger.error("Fetch Failed: %s. HTTP status: %d", url,
-                         response.status_code)
+                         result.status,
+                         extra=_log_fields(watch, "fetch", started))
             return None
 
-        content = response.text
-        soup = BeautifulSoup(content, "html.parser")
-        section = soup.find("section", {"id": element_id})
-        if section:
-            logger.debug("Content fetched from %s", url)
-            return str(section)
+        logger.debug("Content fetched from %s", url,
+                     extra=_log_fields(watch, "fetch", started))
+        # Parsing a big page takes long enough to stall every other check,
+        # so it runs in a worker thread.
+        section = await asyncio.to_thread(self._extract, watch, result)
+        if section is not ELEMENT_MISSING:
+            watch.etag = result.etag
+            watch.last_modified = result.last_modified
+        return section
+
+    @staticmethod
+    def _extract(watch, result):
+        """
+        Extract and normalize the watched element of a fetched page, or
+        return ELEMENT_MISSING. Runs in a worker thread.
+        """
+        started = time.perf_counter()
+        if watch.extraction_mode == RAW_MODE:
+            section = extract_raw_element(result.body, watch.element_id,
+                                          encoding=result.charset)
         else:
+            section = extract_element(result.text, watch.element_id,
+                                      mode=watch.extraction_mode,
+                                      backend=watch.parser_backend)
+        if not section:
             logger.warning(
                 "Element with id: %s not found in the content from url: %s.",
-                element_id,
-                url,
+                watch.element_id,
+                watch.url,
+                extra=_log_fields(watch, "extract", started),
             )
-            return "Element not found"
-
-    def _has_keywords(self, content: str) -> bool:
-        """Check if the content has any of the predefined keywords."""
-        return any(keyword in content.lower()
-                   for keyword in self.config.keywords)
-
-    def _handle_missing_content(self, send_email):
-        """Handle scenarios where the expected content is missing."""
-        send_email("Element Missing", "Element not found", self.config)
-        logger.warning("Element not found. Email sent.")
-
-    def _get_updated_page_hash(self, content, send_email):
-        """Check for updates in the content by comparing MD5 hashes."""
-        new_hash = hashlib.md5(content.encode()).hexdigest()
-        if self.hash != new_hash:
-            self.hash = new_hash
-            logger.info("Content update detected.")
-            send_email(
-                "Content Updated",
-                f"New content available at {self.config.url}. Content: {content}",
-                self.config,
-            )
-        return new_hash
+            return ELEMENT_MISSING
+        logger.debug("Element %s extracted from %s", watch.element_id,
+                     watch.url, extra=_log_fields(watch, "extract", started))
+        if watch.normalizer:
+            started = time.perf_counter()
+            section = watch.normalizer.normalize(str(section))
+            logger.debug("Content of %s normalized", watch.url,
+                         extra=_log_fields(watch, "normalize", started))
+        return section
+
+    @staticmethod
+    def _find_keywords(content, watch) -> dict:
+        """Return the offsets of every predefined keyword found in the content."""
+        if not watch.keywords:
+            return {}
+        return watch.keyword_matcher.matches(str(content))
 
-    def _read_page(self, send_email):
+    def _notify(self, watch, subject, body, message_id=None, diff=None):
+        """
+        Queue a notification about a watch for the sender workers, on the
+        watch's channels and to its subscribers. In digest mode, channels
+        that take digests get the notification in the next digest of each
+        subscriber instead, with the diff after the body.
+        """
+        channels = watch.channels
+        if self.digest is not None:
+            names = [name for name in (channels or self.outbox.channels)
+                     if name in self.outbox.channels]
+            digested = [name for name in names
+                        if self.outbox.channels[name].takes_digests]
+            if digested:
+                self.digest.submit(
+                    digested, watch.subscribers or self.config.recipients,
+                    watch.url, subject, f"{body} {diff}" if diff else body,
+                    message_id)
+            channels = [name for name in names if name not in digested]
+            if not channels:
+                return
+        self.outbox.submit(subject, body, message_id, channels=channels,
+                           recipients=watch.subscribers, url=watch.url,
+                           diff=diff)
+
+    def _record_failure(self, watch, kind):
+        """
+        Record a failed check as part of an incident, and alert when it
+        opens or a summary of it is due. Repeated alerts in between are
+        suppressed.
+        """
+        stored = copy.deepcopy(watch.incidents)
+        decision = self.incident_tracker.fail(watch, kind)
+        if decision is None:
+            return
+        incident = watch.incidents[kind]
+        subject = INCIDENT_SUBJECTS[kind, decision]
+        try:
+            with self.store.transaction():
+                self.store.save_watch_state(watch)
+                self._notify(
+                    watch, subject, _describe_incident(watch, kind, incident),
+                    message_id=_incident_message_id(
+                        watch, kind, incident, incident["alerted_at"]))
+        except Exception:
+            watch.incidents = stored
+            raise
+        logger.warning("%s on %s. Email queued.", subject, watch.url,
+                       extra=_log_fields(watch, "notify"))
+
+    def _resolve_incident(self, watch, kind):
+        """Close an incident after a successful check, reporting recovery."""
+        stored = copy.deepcopy(watch.incidents)
+        incident = self.incident_tracker.resolve(watch, kind)
+        if incident is None:
+            return
+        subject = RECOVERY_SUBJECTS[kind]
+        body = f"Recovered: {_describe_incident(watch, kind, incident)}"
+        try:
+            with self.store.transaction():
+                self.store.save_watch_state(watch)
+                self._notify(watch, subject, body,
+                             message_id=_incident_message_id(
+                                 watch, kind, incident, "resolved"))
+        except Exception:
+            watch.incidents = stored
+            raise
+        logger.info("%s on %s.", subject, watch.url,
+                    extra=_log_fields(watch, "notify"))
+
+    def _check_keywords(self, watch, found):
+        """
+        Alert when keywords appear in or disappear from the content, rather
+        than on every check they are present, and again for keywords still
+        present once the re-alert interval has passed. found holds the
+        keywords in the new content, or is None when it did not change.
+        Returns whether an alert was queued.
+        """
+        if not watch.keywords:
+            return False
+        now = time.time()
+        # The matcher casefolds keywords, so state is kept by casefolded
+        # keyword, while alerts name the keyword as it was configured.
+        names = {}
+        for keyword in watch.keywords:
+            if keyword:
+                names.setdefault(keyword.casefold(), keyword)
+        # Keywords dropped from the watch since the state was stored are
+        # forgotten rather than reported as gone.
+        previous = {keyword.casefold(): alerted_at for keyword, alerted_at
+                    in (watch.keyword_alerts or {}).items()
+                    if keyword.casefold() in names}
+        found = previous.keys() if found is None else found
+        interval = self.config.keyword_realert_interval
+        appeared = [k for k in names if k in found and k not in previous]
+        repeated = [k for k in names
+                    if k in found and k in previous
+                    and interval and now - previous[k] >= interval]
+        gone = [k for k in names if k in previous and k not in found]
+        current = {keyword: previous.get(keyword, now) for keyword in found}
+        for keyword in repeated:
+            current[keyword] = now
+        if not (appeared or repeated or gone):
+            watch.keyword_alerts = current
+            return False
+
+        lines = [f'Keyword "{names[k]}" appeared on {watch.url}.'
+                 for k in appeared]
+        lines += [f'Keyword "{names[k]}" is still present on {watch.url}.'
+                  for k in repeated]
+        lines += [f'Keyword "{names[k]}" disappeared from {watch.url}.'
+                  for k in gone]
+        subject = ("Keyword Detected" if appeared or repeated
+                   else "Keyword Disappeared")
+        stored = watch.keyword_alerts
+        watch.keyword_alerts = current
+        # As with content updates, the new keyword state commits together
+        # with its alert.
+        try:
+            with self.store.transaction():
+                self.store.save_watch_state(watch)
+                self._notify(watch, subject, "<br>".join(lines))
+        except Exception:
+            watch.keyword_alerts = stored
+            raise
+        for label, keywords in (("appeared on", appeared),
+                                ("still present on", repeated),
+                                ("disappeared from", gone)):
+            if keywords:
+                logger.info("Keywords %s %s %s.",
+                            ", ".join(names[k] for k in keywords), label,
+                            watch.url, extra=_log_fields(watch, "keywords"))
+        return True
+
+    @staticmethod
+    def _fingerprint_data(content):
+        """Return what to fingerprint: the source bytes of a RawSection."""
+        return content.view if isinstance(content, RawSection) else content
+
+    def _build_tree(self, content):
+        """
+        Return the Merkle tree of content, or None when it is over the diff
+        size cap, which bounds the work done on a huge page.
+        """
+        if len(content) > self.config.diff_max_bytes:
+            return None
+        return build_tree(content)
+
+    def _describe_update(self, watch, content, tree):
+        """
+        Build the body and the diff of a "Content Updated" notification:
+        a compact diff against the previous content, in the configured diff
+        mode. When the diff is over its size cap or time limit, only the
+        changed blocks are listed, and without previous content the whole
+        content is sent. Runs in a worker thread.
+        """
+        header = f"New content available at {watch.url}."
+        if not watch.content:
+            return header, f"Content: {content}"
+        config = self.config
+        if tree is None or (watch.merkle is None
+                            and len(watch.content) > config.diff_max_bytes):
+            return (f"{header} The content is over {config.diff_max_bytes} "
+                    f"bytes, so the changes are not listed."), None
+        if watch.merkle is not None:
+            blocks = changed_blocks(deserialize(watch.merkle), tree)
+        else:
+            blocks = changed_blocks(build_tree(watch.content), tree)
+        started = time.perf_counter()
+        try:
+            if len(watch.content) + len(content) > config.diff_max_bytes:
+                raise DiffTooLarge(
+                    f"content exceeds {config.diff_max_bytes} bytes")
+            if config.diff_mode == "dom":
+                items = [
+                    f"<li><code>{html.escape(block.path)}</code> "
+                    f"{block.kind}: {block.diff}</li>"
+                    for block in diff_blocks(
+                        watch.content, content, blocks[:MAX_REPORTED_BLOCKS],
+                        algorithm=config.diff_algorithm,
+                        timeout=config.diff_timeout)
+                ]
+            else:
+                return header, "Changes: " + diff_markup(
+                    watch.content, content, config.diff_mode,
+                    config.diff_algorithm, config.diff_timeout)
+        except (DiffTimeout, DiffTooLarge) as error:
+            logger.warning("Diff of %s skipped: %s", watch.url, error,
+                           extra=_log_fields(watch, "diff", started))
+            items = []
+            for block in blocks[:MAX_REPORTED_BLOCKS]:
+                path = html.escape(format_path(block.path))
+                if block.kind == "removed":
+                    items.append(f"<li><code>{path}</code> removed</li>")
+                else:
+                    markup = content[block.node.start:block.node.end]
+                    items.append(
+                        f"<li><code>{path}</code> {block.kind}: {markup}</li>")
+        else:
+            logger.debug("Diffed %s", watch.url,
+                         extra=_log_fields(watch, "diff", started))
+        if len(blocks) > MAX_REPORTED_BLOCKS:
+            items.append(f"<li>and {len(blocks) - MAX_REPORTED_BLOCKS} "
+                         f"more changed blocks</li>")
+        return header, f"Changed blocks:<ul>{''.join(items)}</ul>"
+
+    async def _update_fingerprint(self, watch, content):
+        """
+        Compare the fingerprint of the content with the stored one, and
+        report a change. Returns whether the content changed. A RawSection
+        is fingerprinted from its source bytes and only decoded on a change.
+        """
+        fingerprinter = self.fingerprinter
+        data = self._fingerprint_data(content)
+        if fingerprinter.matches(data, watch.fingerprint,
+                                 watch.fingerprint_algorithm):
+            if watch.fingerprint_algorithm != fingerprinter.algorithm:
+                # Same content, fingerprinted with an older algorithm, or
+                # with one that is not available here.
+                watch.fingerprint = fingerprinter.digest(data)
+                watch.fingerprint_algorithm = fingerprinter.algorithm
+            return False
+
+        content = str(content)
+        new_fingerprint = fingerprinter.digest(data)
+
+        def describe():
+            tree = self._build_tree(content)
+            return tree, self._describe_update(watch, content, tree)
+
+        tree, (body, diff) = await asyncio.to_thread(describe)
+        previous = (watch.fingerprint, watch.fingerprint_algorithm,
+                    watch.content, watch.merkle)
+        # A page can return to an earlier state, so the id names the
+        # transition and the check that saw it, not only the new content.
+        message_id = hashlib.sha1(
+            f"{watch.watch_id}:{(watch.fingerprint or b'').hex()}:"
+            f"{new_fingerprint.hex()}:{watch.last_checked_at}".encode()
+        ).hexdigest()
+        watch.fingerprint = new_fingerprint
+        watch.fingerprint_algorithm = fingerprinter.algorithm
+        watch.content = content
+        watch.merkle = serialize(tree) if tree else None
+        # The new fingerprint and its notification are committed together,
+        # so a crash can neither lose the alert nor send it twice.
+        try:
+            with self.store.transaction():
+                self.store.save_watch_state(watch)
+                self._notify(
+                    watch,
+                    "Content Updated",
+                    body,
+                    message_id=message_id,
+                    diff=diff,
+                )
+        except Exception:
+            # Forget the validators too, or the next check would be
+            # answered with 304 and the change never reported.
+            (watch.fingerprint, watch.fingerprint_algorithm,
+             watch.content, watch.merkle) = previous
+            watch.etag = watch.last_modified = None
+            raise
+        logger.info("Content update detected on %s.", watch.url,
+                    extra=_log_fields(watch, "compare"))
+        return True
+
+    async def _read_page(self, fetcher, watch):
         """Read the content of the page and perform necessary checks."""
-        logger.info("Checking %s for updates...", self.config.url)
+        logger.info("Checking %s for updates...", watch.url,
+                    extra=_log_fields(watch, "check"))
 
-        content = self._fetch_from_url(self.config.url)
+        content = await self._fetch_from_url(fetcher, watch)
+        watch.last_checked_at = time.time()
+        started = time.perf_counter()
+        try:
+            return await self._check_content(watch, content)
+        finally:
+            self.store.queue_watch_state(watch)
+            logger.debug("Compared content of %s", watch.url,
+                         extra=_log_fields(watch, "compare", started))
+
+    async def _check_content(self, watch, content):
+        """Run the incident, keyword and update checks on content."""
+        if content is None:
+            self._record_failure(watch, "fetch")
+            return None
+        self._resolve_incident(watch, "fetch")
 
-        if not content or content == "Element not found":
-            self._handle_missing_content(send_email)
+        if content is ELEMENT_MISSING or not content:
+            self._record_failure(watch, "missing")
             return None
+        self._resolve_incident(watch, "missing")
 
-        if self._has_keywords(content):
-            send_email("Keyword Detected", "Keyword found in the content",
-                       self.config)
-            logger.info("Keyword detected in the content.")
+        if content is NOT_MODIFIED:
+            logger.info("No updates detected on %s.", watch.url,
+                        extra=_log_fields(watch, "compare"))
+            self._check_keywords(watch, None)
+            return watch.fingerprint
 
-        hash_update = self._get_updated_page_hash(content, send_email)
-        if hash_update == self.hash:
-            logger.info("No updates detected on %s.", self.config.url)
-        return hash_update
+        self._check_keywords(watch, await asyncio.to_thread(
+            self._find_keywords, content, watch))
 
-    def run(self, send_email=send_notification_email):
-        """Main loop for periodically checking the page for updates."""
-        while True:
-            try:
-                self._read_page(send_email)
-                Logger.display_timer(self.config.interval)
+        if not await self._update_fingerprint(watch, content):
+            logger.info("No updates detected on %s.", watch.url,
+                        extra=_log_fields(watch, "compare"))
+        return watch.fingerprint
+
+    async def _run_check(self, fetcher, watch, due_at):
+        """Check one watch and schedule its next check."""
+        started = time.perf_counter()
+        try:
+            await self._read_page(fetcher, watch)
+        except Exception as error:
+            logger.exception("Error while checking %s: %s", watch.url,
+                             error, extra=_log_fields(watch, "check", started))
+        finally:
+            self.scheduler.reschedule(watch, due_at)
+            # Free the slot before waking the loop, which may be waiting
+            # for one.
+            self._checks.discard(asyncio.current_task())
+            self._wakeup.set()
+
+    def _dispatch_due(self, fetcher, now):
+        """Start the checks that are due, up to the in-flight limit."""
+        room = self.config.max_concurrent_checks - len(self._checks)
+        for watch, due_at in self.scheduler.pop_due(now, limit=max(0, room)):
+            task = asyncio.create_task(self._run_check(fetcher, watch, due_at))
+            self._checks.add(task)
+            task.add_done_callback(self._checks.discard)
+
+    def _report_status(self, fetcher):
+        """Log revalidation, scheduling and outbox metrics."""
+        report = fetcher.revalidation_report()
+        if report:
+            logger.info(
+                "Revalidation hit rate per host: %s",
+                ", ".join(f"{host} {rate:.0%}" for host, rate in report.items()),
+            )
+        logger.info("Check lag: %s", self.scheduler.lag)
+        logger.info("Cadence error: %s, overruns=%d skipped=%d",
+                    self.scheduler.cadence, self.scheduler.overruns,
+                    self.scheduler.skipped)
+        hits = Counter()
+        for normalizer in {id(watch.normalizer): watch.normalizer
+                           for watch in self.watches
+                           if watch.normalizer}.values():
+            hits.update(normalizer.hits)
+        if hits:
+            logger.info(
+                "Normalization rule hits: %s",
+                ", ".join(f"{rule}={count}"
+                          for rule, count in hits.most_common()),
+            )
+        open_incidents = IncidentTracker.open_incidents(self.watches)
+        logger.info(
+            "Open incidents: %s, alerts suppressed=%d",
+            " ".join(f"{kind}={count}"
+                     for kind, count in open_incidents.items()),
+            self.incident_tracker.suppressed,
+        )
+        if self.digest is not None:
+            logger.info("Digests: %s", self.digest.metrics)
+        for name, channel in self.outbox.channels.items():
+            logger.info("Channel %s: %s", name, channel.metrics)
+        logger.info("Notification outbox: %s", self.outbox.metrics)
 
-            except requests.ConnectionError as error:
-                logger.error("Connection error while accessing %s: %s",
-                             self.config.url, error)
+    def _reload(self, fetcher):
+        """Make every watch that is not being checked due now."""
+        logger.info("Reload requested, checking every watch now")
+        now = time.monotonic()
+        for watch in self.watches:
+            if watch in self.scheduler:
+                self.scheduler.schedule(watch, now)
+        self._report_status(fetcher)
 
-            except requests.Timeout as error:
-                logger.error("Timeout occurred while accessing %s: %s",
-                             self.config.url, error)
+    async def _schedule_loop(self, fetcher):
+        """
+        Dispatch every check when it is due, until shutdown is requested.
+        Between checks the loop sleeps until the next deadline: the next due
+        check, the next status report, or the flush of buffered state.
+        """
+        for watch in self.watches:
+            self.scheduler.schedule_from_last_check(watch)
+        flushed_at = reported_at = time.monotonic()
+        while not self._shutdown.is_set():
+            self._wakeup.clear()
+            if self._reload_requested:
+                self._reload_requested = False
+                self._reload(fetcher)
+            now = time.monotonic()
+            self._dispatch_due(fetcher, now)
 
-            except requests.HTTPError as error:
-                logger.error("HTTP error while accessing %s: %s",
-                             self.config.url, error)
+            if now - flushed_at >= STATE_FLUSH_INTERVAL:
+                self.store.flush()
+                flushed_at = now
+            if now - reported_at >= self.config.status_interval:
+                self._report_status(fetcher)
+                reported_at = now
 
-            except requests.RequestException as error:
-                logger.error("Error while making a request to %s: %s",
-                             self.config.url, error)
+            deadlines = [reported_at + self.config.status_interval]
+            if self.store.buffered_states:
+                deadlines.append(flushed_at + STATE_FLUSH_INTERVAL)
+            next_due_at = self.scheduler.next_due_at()
+            # With every slot taken, an overdue check would make the wait a
+            # busy loop; the next check to finish wakes the loop instead.
+            if (next_due_at is not None and
+                    len(self._checks) < self.config.max_concurrent_checks):
+                deadlines.append(next_due_at)
+            delay = max(0.0, min(deadlines) - time.monotonic())
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+        logger.info("Shutdown requested, stopping the monitor")
 
-            except KeyboardInterrupt:
+    async def run(self, send_email=send_notification_email):
+        """Main loop for periodically checking the pages for updates."""
+        # Fail on unknown parser backends, and run the "auto" probe, now
+        # rather than on the first check.
+        for backend in {watch.parser_backend for watch in self.watches}:
+            select_backend(backend)
+        # Compile the email template now rather than on the first alert.
+        get_renderer(self.config)
+        self.store = StateStore(self.config.state_path,
+                                batch_size=self.config.state_batch_size)
+        # Webhook channels post over the fetcher's session, so it is opened
+        # before the outbox starts and closed only after it has drained.
+        fetcher = self._create_fetcher()
+        await fetcher.open()
+        channels = self.config.channels or [SMTPChannel(send_email=send_email)]
+        for channel in channels:
+            channel.bind(fetcher)
+        self.outbox = NotificationOutbox(
+            channels,
+            self.config,
+            self.store,
+            maxsize=self.config.outbox_size,
+            workers=self.config.outbox_workers,
+            policy=self.config.outbox_policy,
+        )
+        self.outbox.start()
+        digests = None
+        if self.config.digest_window:
+            self.digest = DigestBatcher(
+                self.outbox,
+                self.store,
+                window=self.config.digest_window,
+                max_events=self.config.digest_max_events,
+            )
+            digests = asyncio.create_task(self.digest.run())
+        signals = self._install_signal_handlers()
+        display = None
+        if self.config.display:
+            display = asyncio.create_task(Logger.display_countdown(
+                self.scheduler.next_due_at, self.config.display_refresh))
+        try:
+            await self._initialize(fetcher)
+            try:
+                await self._schedule_loop(fetcher)
+            except (KeyboardInterrupt, asyncio.CancelledError):
                 logger.info("Monitoring interrupted by user")
-                break
-
-            # except Exception as e:
-            #     logger.error(
-            #         "An unexpected error occurred while monitoring %s: %s",
-            #         self.config.url, e
-            #     )
+            finally:
+                for task in list(self._checks):
+                    task.cancel()
+                await asyncio.gather(*self._checks, return_exceptions=True)
+        finally:
+            if display is not None:
+                display.cancel()
+                await asyncio.gather(display, return_exceptions=True)
+            for signum in signals:
+                asyncio.get_running_loop().remove_signal_handler(signum)
+            if digests is not None:
+                digests.cancel()
+                await asyncio.gather(digests, return_exceptions=True)
+            if self.digest is not None:
+                # Send what is waiting rather than hold it until the next run.
+                self.digest.flush(force=True)
+            await self.outbox.stop()
+            await fetcher.close()
+            close_smtp_pools()
+            self.store.close()